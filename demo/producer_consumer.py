@@ -28,10 +28,9 @@ class Producer(PeriodicTask):
         self.consumer = self.service.tasks.Consumer
 
     def execute(self, *args, **kwargs):
-        for i in xrange(5):
-            item = random.random()
-            self.consumer.queue.put(item)
-            self.logger.info("Producer put %s into queue", item)
+        items = [random.random() for i in xrange(5)]
+        self.consumer.put_many(items)
+        self.logger.info("Producer put %s into queue", items)
 
 
 class ProducerConsumer(VService):
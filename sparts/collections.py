@@ -1,19 +1,279 @@
-import heapq
+from collections import deque, OrderedDict
 
-from six.moves.queue import Queue
+import itertools
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from six.moves import cPickle as pickle
+from six.moves import queue
+
+
+class Queue(queue.Queue):
+    """A Queue subclass that can also `put_many` items at once, and make room
+    for new items by evicting queued ones with `put_evict`"""
+
+    def put_many(self, items, block=True, timeout=None):
+        """Put all `items`, acquiring the queue's lock only once.
+
+        If the queue is bounded, this blocks (per `block` and `timeout`) while
+        it is full, like `put`, and items put so far remain in the queue if
+        `Full` is raised."""
+        items = list(items)
+        pending = 0
+        with self.not_full:
+            try:
+                for item in items:
+                    if self.maxsize > 0 and self._qsize() >= self.maxsize:
+                        # Let consumers make room before waiting on them
+                        self.not_empty.notify(pending)
+                        pending = 0
+                        self._waitNotFull(block, timeout)
+                    self._put(item)
+                    self.unfinished_tasks += 1
+                    pending += 1
+            finally:
+                self.not_empty.notify(pending)
+
+    # The kinds of item `put_evict` can evict from this type of queue
+    EVICTS = ('oldest',)
+
+    def put_evict(self, item, evict='oldest', keep=None):
+        """Put `item` without blocking, evicting an item if the queue is full.
+
+        Evicts the `evict` item, one of `EVICTS`, but never the `keep` item.
+        This may be `item` itself, e.g., if it has the lowest priority.
+        Returns the evicted item, or None if there was room."""
+        if evict not in self.EVICTS:
+            raise ValueError("%s can't evict the %s item" %
+                             (self.__class__.__name__, evict))
+
+        with self.mutex:
+            self._put(item)
+            evicted = None
+            if self.maxsize > 0 and self._qsize() > self.maxsize:
+                evicted = self._evict(evict, keep)
+            else:
+                self.unfinished_tasks += 1
+            if evicted is not item:
+                self.not_empty.notify()
+        return evicted
+
+    def oldest_time(self, key):
+        """Returns `key(item)` (e.g., when it was put) for the oldest queued
+        item, or None if the queue is empty"""
+        with self.mutex:
+            if not self.queue:
+                return None
+            return key(self.queue[0])
+
+    def _evict(self, evict, keep):
+        """Removes and returns the `evict` item (other than `keep`)"""
+        for i, item in enumerate(self.queue):
+            if item is not keep:
+                del self.queue[i]
+                return item
+
+    def _waitNotFull(self, block, timeout):
+        """Waits on the `not_full` condition, like `put()`, holding the lock"""
+        if not block:
+            raise queue.Full
+        if timeout is None:
+            while self._qsize() >= self.maxsize:
+                self.not_full.wait()
+        else:
+            endtime = time.time() + timeout
+            while self._qsize() >= self.maxsize:
+                remaining = endtime - time.time()
+                if remaining <= 0.0:
+                    raise queue.Full
+                self.not_full.wait(remaining)
+
+
+# The fields of `PriorityQueue` heap entries, which are lists so they can be
+# updated in place.  Comparing entries never gets past the unique sequence
+# number, so items themselves are never compared.
+_SORT_KEY, _SEQ, _ITEM, _PUT_TIME, _POS = range(5)
 
 
 class PriorityQueue(Queue):
-    """A Queue subclass that uses `heapq` to maintain a priority queue"""
+    """A Queue subclass that maintains a heap to get the lowest priority first
+
+    An item's priority is `key(item)`, or the item itself if `key` is None,
+    and items with equal priorities are got in the order they were put.  If
+    `aging` is set, the priority of queued items decreases by that much per
+    second, so that items with a high priority value don't starve.
+
+    Queued (hashable) items are indexed, so they can be re-prioritized with
+    `update_priority`, or removed with `remove`, in O(log n) time."""
+
+    def __init__(self, maxsize=0, key=None, aging=0.0):
+        self.key = key
+        self.aging = aging
+        Queue.__init__(self, maxsize)
 
     def _init(self, maxsize):
-        self.queue = []
+        self._heap = []
+        self._seq = itertools.count()
+        # Entries by item, and in the order they were put
+        self._index = {}
+        self._entries = OrderedDict()
+        # Items `interrupt` put in front of the queue
+        self._interrupts = deque()
+
+    @property
+    def queue(self):
+        """The queued items, in heap order"""
+        return [entry[_ITEM] for entry in self._heap]
+
+    def _qsize(self):
+        return len(self._heap) + len(self._interrupts)
 
     def _put(self, item):
-        heapq.heappush(self.queue, item)
+        put_time = time.time() if self.aging else 0.0
+        entry = [self._sortKey(item, put_time), next(self._seq), item,
+                 put_time, len(self._heap)]
+        self._heap.append(entry)
+        self._siftDown(entry[_POS])
+        self._entries[entry[_SEQ]] = entry
+        try:
+            self._index.setdefault(item, []).append(entry)
+        except TypeError:
+            # Unhashable items can be queued, but not looked up
+            pass
 
     def _get(self):
-        return heapq.heappop(self.queue)
+        if self._interrupts:
+            return self._interrupts.popleft()
+        entry = self._heap[0]
+        self._removeEntry(entry)
+        return entry[_ITEM]
+
+    def _sortKey(self, item, put_time, priority=None):
+        if priority is None:
+            priority = item if self.key is None else self.key(item)
+        if self.aging:
+            # Aging doesn't change the order of queued items relative to
+            # each other, so only the priority as of when it was put is kept
+            return priority + self.aging * put_time
+        return priority
+
+    def interrupt(self, item):
+        """Put `item` in front of the queued items, regardless of priority"""
+        with self.mutex:
+            self._interrupts.append(item)
+            self.not_empty.notify()
+
+    def update_priority(self, item, priority=None):
+        """Re-prioritize the queued `item`, to `priority` or its `key`
+
+        Raises ValueError if it isn't queued."""
+        with self.mutex:
+            entries = self._index.get(item)
+            if not entries:
+                raise ValueError("%r is not queued" % (item,))
+            for entry in entries:
+                entry[_SORT_KEY] = self._sortKey(entry[_ITEM],
+                                                 entry[_PUT_TIME], priority)
+                self._siftDown(entry[_POS])
+                self._siftUp(entry[_POS])
+
+    def remove(self, item):
+        """Remove the oldest queued `item`, and return it.
+
+        Raises ValueError if it isn't queued."""
+        with self.mutex:
+            entries = self._index.get(item)
+            if not entries:
+                raise ValueError("%r is not queued" % (item,))
+            entry = entries[0]
+            self._removeEntry(entry)
+
+            # It won't be got, so it won't be marked done by `task_done`
+            self.unfinished_tasks -= 1
+            if self.unfinished_tasks == 0:
+                self.all_tasks_done.notify_all()
+            self.not_full.notify()
+            return entry[_ITEM]
+
+    def oldest_time(self, key):
+        with self.mutex:
+            for entry in self._entries.values():
+                return key(entry[_ITEM])
+            return None
+
+    EVICTS = ('lowest', 'oldest')
+
+    def _evict(self, evict, keep):
+        if evict == 'oldest':
+            for entry in self._entries.values():
+                if entry[_ITEM] is not keep:
+                    break
+        else:
+            # The lowest priority item is one of the heap's leaves
+            heap = self._heap
+            entry = max(e for e in heap[len(heap) // 2:]
+                        if e[_ITEM] is not keep)
+        self._removeEntry(entry)
+        return entry[_ITEM]
+
+    def _removeEntry(self, entry):
+        heap = self._heap
+        last = heap.pop()
+        if last is not entry:
+            pos = entry[_POS]
+            heap[pos] = last
+            last[_POS] = pos
+            self._siftDown(pos)
+            self._siftUp(last[_POS])
+
+        del self._entries[entry[_SEQ]]
+        try:
+            entries = self._index[entry[_ITEM]]
+        except TypeError:
+            return
+        if len(entries) == 1:
+            del self._index[entry[_ITEM]]
+        else:
+            entries.remove(entry)
+
+    def _siftDown(self, pos):
+        """Moves the entry at `pos` towards the root, like `heapq._siftdown`"""
+        heap = self._heap
+        entry = heap[pos]
+        while pos > 0:
+            parentpos = (pos - 1) >> 1
+            parent = heap[parentpos]
+            if not entry < parent:
+                break
+            heap[pos] = parent
+            parent[_POS] = pos
+            pos = parentpos
+        heap[pos] = entry
+        entry[_POS] = pos
+
+    def _siftUp(self, pos):
+        """Moves the entry at `pos` towards the leaves, like `heapq._siftup`"""
+        heap = self._heap
+        end = len(heap)
+        entry = heap[pos]
+        childpos = 2 * pos + 1
+        while childpos < end:
+            rightpos = childpos + 1
+            if rightpos < end and heap[rightpos] < heap[childpos]:
+                childpos = rightpos
+            child = heap[childpos]
+            if not child < entry:
+                break
+            heap[pos] = child
+            child[_POS] = pos
+            pos = childpos
+            childpos = 2 * pos + 1
+        heap[pos] = entry
+        entry[_POS] = pos
 
 
 class Duplicate(Exception):
@@ -27,7 +287,7 @@ class UniqueQueue(Queue):
     `silent` attribute may be set to True, in order to change this
     behavior to silently discard the duplicates instead of raising."""
     def _init(self, maxsize):
-        Queue._init(self, maxsize)
+        queue.Queue._init(self, maxsize)
         self._seen = set()
         self._discards = 0
         self.silent = False
@@ -43,11 +303,18 @@ class UniqueQueue(Queue):
             else:
                 raise Duplicate
 
-        Queue._put(self, item)
+        queue.Queue._put(self, item)
         self._seen.add(item)
 
     def _get(self):
-        item = Queue._get(self)
+        item = queue.Queue._get(self)
+        if not self.explicit_unsee:
+            self._seen.remove(item)
+        return item
+
+    def _evict(self, evict, keep):
+        # Like `_get`, evicted items must be explicitly unseen, if enabled
+        item = Queue._evict(self, evict, keep)
         if not self.explicit_unsee:
             self._seen.remove(item)
         return item
@@ -58,3 +325,524 @@ class UniqueQueue(Queue):
 
         with self.mutex:
             self._seen.remove(item)
+
+
+class _Shard(object):
+    """One of a `WorkStealingQueue`'s deques, and the lock guarding it"""
+    __slots__ = ['items', 'lock', 'not_empty', 'unfinished', 'waiting']
+
+    def __init__(self):
+        self.items = deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.unfinished = 0
+        self.waiting = 0
+
+
+class WorkStealingQueue(object):
+    """A queue with a deque for each consumer thread, to spread lock contention
+
+    Items are put on the `nshards` deques round-robin or, if `key(item)`
+    returns something other than None, by the hash of that key.  Consumers
+    `get` from their own deque and, once it's empty, steal the oldest item
+    from the others.  If `ordered` is set, they don't steal, so all the items
+    with the same key are got in order by the same consumer; this requires at
+    most `nshards` consumer threads.
+
+    It supports the subset of the `Queue` API that `QueueTask` uses.  It is
+    unbounded, and `task_done` must be called by the thread that got the
+    item."""
+    EVICTS = ()
+
+    def __init__(self, nshards, key=None, ordered=False):
+        if nshards < 1:
+            raise ValueError("nshards must be positive")
+        self.maxsize = 0
+        self.key = key
+        self.ordered = ordered
+        self._shards = [_Shard() for i in range(nshards)]
+        self._put_seq = itertools.count()
+        self._owner_seq = itertools.count()
+        self._local = threading.local()
+        self._interrupt = None
+
+        # Idle consumers that can steal wait on `not_empty`, and `join`s on
+        # `all_tasks_done`.  Producers only lock `mutex` while they do.
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.all_tasks_done = threading.Condition(self.mutex)
+        self._idle = 0
+        self._joining = 0
+
+    @property
+    def queue(self):
+        """A snapshot of the queued items, deque by deque"""
+        items = []
+        for shard in self._shards:
+            with shard.lock:
+                items.extend(shard.items)
+        return items
+
+    @property
+    def unfinished_tasks(self):
+        return sum(shard.unfinished for shard in self._shards)
+
+    def qsize(self):
+        return sum(len(shard.items) for shard in self._shards)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def full(self):
+        return False
+
+    def put(self, item, block=True, timeout=None):
+        """Put `item` on the deque for its key, or the next one.  Never blocks"""
+        shard = self._shardFor(item)
+        with shard.lock:
+            shard.items.append(item)
+            shard.unfinished += 1
+            if shard.waiting:
+                shard.not_empty.notify()
+
+        # Checked after appending, as `_wait` checks the deques after idling
+        if self._idle:
+            with self.mutex:
+                self.not_empty.notify()
+
+    def put_nowait(self, item):
+        return self.put(item, block=False)
+
+    def get(self, block=True, timeout=None):
+        index = self._ownIndex()
+        shard = self._shards[index]
+        endtime = None
+        if timeout is not None:
+            endtime = time.time() + timeout
+        while True:
+            if self._interrupt is not None:
+                return self._interrupt
+            for victim in self._victims(index):
+                with victim.lock:
+                    if victim.items:
+                        self._local.got.append(victim)
+                        return victim.items.popleft()
+
+            if not block:
+                raise queue.Empty
+            remaining = None
+            if endtime is not None:
+                remaining = endtime - time.time()
+                if remaining <= 0.0:
+                    raise queue.Empty
+            self._wait(shard, remaining)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def task_done(self):
+        got = getattr(self._local, 'got', None)
+        if not got:
+            raise ValueError('task_done() called too many times')
+        shard = got.popleft()
+        with shard.lock:
+            shard.unfinished -= 1
+
+        # Checked after finishing, as `join` counts after joining
+        if self._joining:
+            with self.mutex:
+                self.all_tasks_done.notify_all()
+
+    def join(self):
+        with self.mutex:
+            self._joining += 1
+            try:
+                while self.unfinished_tasks:
+                    self.all_tasks_done.wait()
+            finally:
+                self._joining -= 1
+
+    def oldest_time(self, key):
+        """Returns the earliest `key(item)` of the oldest item on each
+        deque, ignoring Nones, or None if there are none"""
+        times = []
+        for shard in self._shards:
+            with shard.lock:
+                if not shard.items:
+                    continue
+                head = shard.items[0]
+            t = key(head)
+            if t is not None:
+                times.append(t)
+        return min(times) if times else None
+
+    def interrupt(self, item):
+        """Make all current and future `get`s return `item` instead of work"""
+        self._interrupt = item
+        with self.mutex:
+            self.not_empty.notify_all()
+        for shard in self._shards:
+            with shard.lock:
+                shard.not_empty.notify_all()
+
+    def _shardFor(self, item):
+        if self.key is not None:
+            key = self.key(item)
+            if key is not None:
+                return self._shards[hash(key) % len(self._shards)]
+        return self._shards[next(self._put_seq) % len(self._shards)]
+
+    def _ownIndex(self):
+        """Returns the index of the calling consumer's deque, assigning one"""
+        index = getattr(self._local, 'index', None)
+        if index is None:
+            index = next(self._owner_seq) % len(self._shards)
+            self._local.index = index
+            # The deques items were got from, for `task_done`
+            self._local.got = deque()
+        return index
+
+    def _victims(self, index):
+        """Yields the consumer's own deque, then the ones it may steal from"""
+        yield self._shards[index]
+        if self.ordered:
+            return
+        n = len(self._shards)
+        for i in range(1, n):
+            yield self._shards[(index + i) % n]
+
+    def _wait(self, shard, timeout):
+        """Waits up to `timeout` for an item this consumer can get"""
+        if self.ordered:
+            with shard.lock:
+                if shard.items or self._interrupt is not None:
+                    return
+                shard.waiting += 1
+                try:
+                    shard.not_empty.wait(timeout)
+                finally:
+                    shard.waiting -= 1
+            return
+
+        with self.mutex:
+            self._idle += 1
+            try:
+                if self._interrupt is None and self.qsize() == 0:
+                    self.not_empty.wait(timeout)
+            finally:
+                self._idle -= 1
+
+
+_UNLOADED = object()
+
+
+class _Segment(object):
+    """One of a `DurableQueue`'s log files, mapped for reading"""
+    __slots__ = ['number', 'path', 'file', 'map', 'size', 'live']
+
+    def __init__(self, number, path, size=None):
+        self.number = number
+        self.path = path
+        self.live = 0
+        # Unbuffered, so that writes are visible through the map right away
+        if size is None:
+            self.file = open(path, 'r+b', 0)
+            self.size = os.fstat(self.file.fileno()).st_size
+        else:
+            self.file = open(path, 'w+b', 0)
+            self.file.truncate(size)
+            self.size = size
+        self.map = mmap.mmap(self.file.fileno(), self.size,
+                             access=mmap.ACCESS_READ)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class DurableQueue(Queue):
+    """A Queue that persists its items in a log of segment files in `path`
+
+    Items must be picklable.  Each `put` appends a record to the current
+    segment, and waits for it to be fsynced unless `fsync` is False, in which
+    case the items survive the process crashing, but not the host.  Puts
+    waiting at the same time share an fsync ("group commit").
+
+    Once an item has been processed, `ack` the object `get` returned to
+    append an acknowledgement record; segments are deleted once all their
+    items have been acknowledged.  When the queue is opened again, items that
+    weren't acknowledged are queued again, in the order they were put, so
+    they're delivered at least once.  These are only read back, through a
+    memory map, when they're got.  Every `put` appends a new record, even
+    for an item that is in flight; use `requeue` to put an item back in
+    place of its previous record instead."""
+    SEGMENT_BYTES = 64 << 20
+
+    # Records are a header (payload length, crc32 of the rest, kind, item
+    # sequence number, put time), then the pickled item for puts.  Segments
+    # are preallocated, so a zeroed header marks the end of their records.
+    _HEADER = struct.Struct('<IIBQd')
+    _PUT = 1
+    _ACK = 2
+
+    def __init__(self, path, maxsize=0, segment_bytes=SEGMENT_BYTES,
+                 fsync=True):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        Queue.__init__(self, maxsize)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._replay()
+
+    def _init(self, maxsize):
+        Queue._init(self, maxsize)
+        # Items `interrupt` put in front of the queue, without persisting them
+        self._transient = deque()
+        # `get` items by id, with the sequence number and segment of their
+        # record, until they're acknowledged
+        self._inflight = {}
+        self._segments = []
+        self._seq = itertools.count()
+        self._written = 0
+        self._dirty = set()
+        self._closing = []
+        self._fsyncing = False
+        self._synced = 0
+        self._sync_cond = threading.Condition()
+
+    def _replay(self):
+        """Opens the existing segments, and re-queues unacknowledged items"""
+        puts = {}
+        acks = set()
+        names = sorted(name for name in os.listdir(self.path)
+                       if name.endswith('.log'))
+        for name in names:
+            segment = _Segment(int(name[:-len('.log')], 16),
+                               os.path.join(self.path, name))
+            self._segments.append(segment)
+            self._offset = self._scan(segment, puts, acks)
+
+        if not self._segments:
+            self._offset = 0
+            self._segments.append(self._newSegment(0, self.segment_bytes))
+
+        for seq in sorted(set(puts) - acks):
+            segment, offset, length, put_time = puts[seq]
+            segment.live += 1
+            self.queue.append((seq, segment, offset, length, _UNLOADED,
+                               put_time))
+        self.unfinished_tasks = len(self.queue)
+        if puts:
+            self._seq = itertools.count(max(puts) + 1)
+        self._collect()
+
+    def _scan(self, segment, puts, acks):
+        """Reads `segment`'s records, returning the offset after the last"""
+        offset = 0
+        header_size = self._HEADER.size
+        while offset + header_size <= segment.size:
+            length, crc, kind, seq, put_time = self._HEADER.unpack_from(
+                segment.map, offset)
+            end = offset + header_size + length
+            if kind not in (self._PUT, self._ACK) or end > segment.size:
+                break
+            if crc != self._crc(kind, seq, put_time,
+                                segment.map[offset + header_size:end]):
+                # e.g., torn by a crash while it was being written
+                break
+
+            if kind == self._PUT:
+                puts[seq] = (segment, offset + header_size, length, put_time)
+            else:
+                acks.add(seq)
+            offset = end
+        return offset
+
+    @staticmethod
+    def _crc(kind, seq, put_time, payload):
+        return zlib.crc32(struct.pack('<BQd', kind, seq, put_time) +
+                          payload) & 0xffffffff
+
+    def _newSegment(self, number, size):
+        return _Segment(number, os.path.join(self.path, '%016x.log' % number),
+                        size=size)
+
+    def _append(self, kind, seq, payload=b'', put_time=0.0):
+        """Appends a record to the current segment, returning its payload's
+        segment and offset"""
+        size = self._HEADER.size + len(payload)
+        segment = self._segments[-1]
+        if self._offset + size > segment.size:
+            segment = self._newSegment(segment.number + 1,
+                                       max(size, self.segment_bytes))
+            self._segments.append(segment)
+            self._offset = 0
+
+        offset = self._offset
+        segment.file.seek(offset)
+        segment.file.write(self._HEADER.pack(
+            len(payload), self._crc(kind, seq, put_time, payload), kind, seq,
+            put_time) + payload)
+        self._offset += size
+        self._written += 1
+        self._dirty.add(segment)
+        return segment, offset + self._HEADER.size
+
+    def _put(self, item):
+        seq = next(self._seq)
+        payload = pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+        put_time = time.time()
+        segment, offset = self._append(self._PUT, seq, payload, put_time)
+        segment.live += 1
+        # Items put by this process are kept as is, e.g., with their futures
+        self.queue.append((seq, segment, offset, len(payload), item,
+                           put_time))
+
+    def _qsize(self):
+        return len(self.queue) + len(self._transient)
+
+    def _get(self):
+        if self._transient:
+            return self._transient.popleft()
+        return self._load(self.queue.popleft())
+
+    def _load(self, entry):
+        """Returns the queued item at `entry`, which is now in flight"""
+        seq, segment, offset, length, item, put_time = entry
+        if item is _UNLOADED:
+            item = pickle.loads(segment.map[offset:offset + length])
+        self._inflight.setdefault(id(item), []).append((item, seq, segment))
+        return item
+
+    def oldest_time(self, key):
+        """Returns `key(item)` for the oldest queued item or, if it was
+        replayed and hasn't been read back yet, when it was put"""
+        with self.mutex:
+            if not self.queue:
+                return None
+            entry = self.queue[0]
+            if entry[4] is _UNLOADED:
+                return entry[5]
+            return key(entry[4])
+
+    def _evict(self, evict, keep):
+        # Evicted items are in flight until they're acknowledged, too
+        return self._load(self.queue.popleft())
+
+    def put(self, item, block=True, timeout=None):
+        Queue.put(self, item, block, timeout)
+        self._commit()
+
+    def put_many(self, items, block=True, timeout=None):
+        try:
+            Queue.put_many(self, items, block, timeout)
+        finally:
+            self._commit()
+
+    def put_evict(self, item, evict='oldest', keep=None):
+        evicted = Queue.put_evict(self, item, evict, keep)
+        self._commit()
+        return evicted
+
+    def requeue(self, item, got=None, block=True, timeout=None):
+        """Put `item` back on the queue in place of `got` (by default,
+        `item` itself), which was got from it but not acknowledged.
+
+        `got`'s record is acknowledged along with writing `item`'s, so that
+        one of them is always replayed.  If `Full` is raised, `got` is still
+        in flight."""
+        if got is None:
+            got = item
+        with self.not_full:
+            if self.maxsize > 0 and self._qsize() >= self.maxsize:
+                self._waitNotFull(block, timeout)
+            self._put(item)
+            self.unfinished_tasks += 1
+            self._ack(got)
+            self.not_empty.notify()
+        self._commit()
+
+    def interrupt(self, item):
+        """Put `item` in front of the queued items, without persisting it"""
+        with self.mutex:
+            self._transient.append(item)
+            self.not_empty.notify()
+
+    def ack(self, item):
+        """Acknowledge that `item`, which was got from the queue, is done.
+
+        Returns False if it wasn't in flight."""
+        with self.mutex:
+            return self._ack(item)
+
+    def _ack(self, item):
+        inflight = self._inflight.get(id(item))
+        if not inflight:
+            return False
+
+        item, seq, segment = inflight.pop()
+        if not inflight:
+            del self._inflight[id(item)]
+        self._append(self._ACK, seq)
+        segment.live -= 1
+        self._collect()
+        return True
+
+    def _collect(self):
+        """Deletes the oldest segments, once all their items are acknowledged
+
+        Later segments may hold acknowledgements for items in earlier ones,
+        so segments are only ever deleted oldest first."""
+        while len(self._segments) > 1 and self._segments[0].live == 0:
+            segment = self._segments.pop(0)
+            self._dirty.discard(segment)
+            os.remove(segment.path)
+            if self._fsyncing:
+                # It may be being fsynced right now
+                self._closing.append(segment)
+            else:
+                segment.close()
+
+    def _commit(self):
+        if self.fsync:
+            self.sync()
+
+    def sync(self):
+        """Waits for all the records written so far to be fsynced.
+
+        Concurrent callers wait for one of them to fsync for all of them."""
+        with self.mutex:
+            target = self._written
+        with self._sync_cond:
+            while self._synced < target:
+                if self._fsyncing:
+                    self._sync_cond.wait()
+                    continue
+
+                with self.mutex:
+                    self._fsyncing = True
+                    written = self._written
+                    dirty, self._dirty = self._dirty, set()
+                self._sync_cond.release()
+                try:
+                    for segment in dirty:
+                        os.fsync(segment.file.fileno())
+                finally:
+                    self._sync_cond.acquire()
+                    with self.mutex:
+                        self._fsyncing = False
+                        closing, self._closing = self._closing, []
+                    for segment in closing:
+                        segment.close()
+                    self._sync_cond.notify_all()
+                self._synced = max(self._synced, written)
+
+    def close(self):
+        """Closes the segment files.  The queue can't be used after this"""
+        self.sync()
+        with self.mutex:
+            for segment in self._segments + self._closing:
+                segment.close()
+            self._segments = []
+            self._closing = []
@@ -7,12 +7,18 @@
 """Module for implementing time-series counters."""
 from __future__ import absolute_import
 
+from bisect import bisect_left
 from collections import deque
 from functools import partial
-from six import next
+from itertools import chain
+from operator import itemgetter
+from six import iteritems, next
 from sparts.sparts import _Nameable, _Bindable, ProvidesCounters
 
+import math
+import threading
 import time
+import weakref
 
 
 class SampleType:
@@ -23,6 +29,66 @@ class SampleType:
     AVERAGE = 'avg'
     MAX = 'max'
     MIN = 'min'
+    RATE = 'rate'
+    P50 = 'p50'
+    P90 = 'p90'
+    P95 = 'p95'
+    P99 = 'p99'
+    P999 = 'p999'
+
+
+class _ShardOwner(object):
+    """Kept in a thread's local storage, so it's collected when it exits"""
+    __slots__ = ('shard', '__weakref__')
+
+    def __init__(self, shard):
+        self.shard = shard
+
+
+class _ThreadShards(object):
+    """Lazily creates one `factory()` shard per thread that calls `get()`
+
+    Each thread only ever writes to its own shard, so writers never contend
+    or lose updates to each other; readers iterate over every shard and
+    combine them.  When a thread exits, its shard (and the data in it) is
+    handed over to the next new thread, so there are only ever as many
+    shards as there have been concurrent threads.
+    """
+    def __init__(self, factory):
+        self._factory = factory
+        self._local = threading.local()
+        # Re-entrant, in case a thread's shard is released by GC in `get()`
+        self._lock = threading.RLock()
+        self._shards = []
+        self._free = []
+        self._owners = set()
+
+    def get(self):
+        """Returns the calling thread's shard, creating it if necessary"""
+        try:
+            return self._local.owner.shard
+        except AttributeError:
+            with self._lock:
+                if self._free:
+                    shard = self._free.pop()
+                else:
+                    shard = self._factory()
+                    self._shards.append(shard)
+                owner = _ShardOwner(shard)
+                self._owners.add(weakref.ref(
+                    owner, partial(self._release, shard)))
+            self._local.owner = owner
+            return shard
+
+    def _release(self, shard, ref):
+        """Called once the thread that owned `shard` has exited"""
+        with self._lock:
+            self._owners.discard(ref)
+            self._free.append(shard)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(self._shards[:])
 
 
 class _BaseCounter(_Nameable, _Bindable, ProvidesCounters):
@@ -49,6 +115,17 @@ class _BaseCounter(_Nameable, _Bindable, ProvidesCounters):
     def add(self, value):
         raise NotImplementedError()
 
+    def merge(self, bucket):
+        """Fold the pre-aggregated `_SampleBucket`, `bucket`, into this"""
+        raise NotImplementedError()
+
+    def _genSampleValues(self, window, span):
+        """Yields the (suffix, value) pair(s) to export for a `Samples` window
+
+        `span` is how many seconds the merged samples actually cover, which
+        may exceed `window` if it was rounded out to whole time slices."""
+        yield self.suffix, self.getvalue()
+
     def __call__(self):
         return self.getvalue()
 
@@ -88,11 +165,53 @@ class CallbackCounter(_BaseCounter):
 
 
 class Sum(ValueCounter):
-    """A running total"""
+    """A running total
+
+    Pass `sharded=True` for totals that are updated from many threads at
+    once; each thread then adds to its own shard, and shards are summed
+    when the value is read.
+
+    Pass `windows` to additionally export the per-second rate of the total
+    over each window, as "<name>.rate.<window>"."""
     suffix = SampleType.SUM
 
+    def __init__(self, name=None, sharded=False, windows=None):
+        self.sharded = sharded
+        self.windows = windows
+        self._shards = None
+        if sharded:
+            self._shards = _ThreadShards(lambda: [0.0])
+        self._series = None
+        if windows:
+            self._series = Samples(types=[SampleType.RATE], windows=windows,
+                                   name=name, granularity=1, sharded=sharded)
+        super(Sum, self).__init__(name=name)
+
+    def _bind(self, obj):
+        return self.__class__(name=self.name, sharded=self.sharded,
+                              windows=self.windows)
+
+    def _genCounterCallbacks(self):
+        yield self.name, self
+        if self._series is not None:
+            for cn, cv in self._series._genCounterCallbacks():
+                yield cn, cv
+
+    def getvalue(self):
+        if self._shards is None:
+            return self._value
+        return self._value + sum(shard[0] for shard in self._shards)
+
     def add(self, value):
-        self._value += value
+        if self._shards is None:
+            self._value += value
+        else:
+            self._shards.get()[0] += value
+        if self._series is not None:
+            self._series.add(value)
+
+    def merge(self, bucket):
+        self._value += bucket.sum
 
     def increment(self):
         self.add(1.0)
@@ -101,7 +220,13 @@ class Sum(ValueCounter):
         self.add(value)
 
     def reset(self, value=0):
+        # For sharded sums, adds racing with a reset may or may not be lost
         self._value = value
+        if self._shards is not None:
+            for shard in self._shards:
+                shard[0] = 0.0
+        if self._series is not None:
+            self._series.reset()
 
 counter = Sum
 
@@ -113,6 +238,17 @@ class Count(ValueCounter):
     def add(self, value):
         self._value += 1
 
+    def merge(self, bucket):
+        self._value += bucket.count
+
+class Rate(Sum):
+    """A running total, exported per second of its `Samples` window"""
+    suffix = SampleType.RATE
+
+    def _genSampleValues(self, window, span):
+        yield self.suffix, self.getvalue() / span
+
+
 class Average(_BaseCounter):
     """A running average"""
     suffix = SampleType.AVERAGE
@@ -127,6 +263,10 @@ class Average(_BaseCounter):
         self._total += value
         self._count += 1
 
+    def merge(self, bucket):
+        self._total += bucket.sum
+        self._count += bucket.count
+
     def getvalue(self):
         if self._count == 0:
             return None
@@ -144,6 +284,10 @@ class Max(ValueCounter):
         elif value > self._value:
             self._value = value
 
+    def merge(self, bucket):
+        if bucket.max is not None:
+            self.add(bucket.max)
+
 
 class Min(ValueCounter):
     """A running minimum"""
@@ -156,10 +300,184 @@ class Min(ValueCounter):
         elif value < self._value:
             self._value = value
 
+    def merge(self, bucket):
+        if bucket.min is not None:
+            self.add(bucket.min)
+
     def getvalue(self):
         return self._value
 
-# TODO: Percentiles!!
+
+class QuantileSketch(object):
+    """A bounded-memory, mergeable estimator for quantiles of a stream
+
+    Values are counted in logarithmically sized buckets, so any quantile
+    returned is within `relative_accuracy` of a value actually added.  At
+    most `max_buckets` buckets are kept for each sign; beyond that, the
+    smallest magnitude buckets are collapsed together, trading accuracy of
+    the low quantiles for bounded memory.
+    """
+    MIN_VALUE = 1e-9
+
+    def __init__(self, relative_accuracy=0.01, max_buckets=2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self._gamma = (1.0 + relative_accuracy) / (1.0 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self.clear()
+
+    def clear(self):
+        self._positive = {}
+        self._negative = {}
+        self._zero = 0
+        self.count = 0
+
+    def _key(self, value):
+        return int(math.ceil(math.log(value) / self._log_gamma))
+
+    def _value(self, key):
+        return 2.0 * self._gamma ** key / (self._gamma + 1.0)
+
+    def add(self, value, count=1):
+        """Count `value` as having been seen `count` times"""
+        if value > self.MIN_VALUE:
+            store = self._positive
+            key = self._key(value)
+        elif value < -self.MIN_VALUE:
+            store = self._negative
+            key = self._key(-value)
+        else:
+            self._zero += count
+            self.count += count
+            return
+
+        store[key] = store.get(key, 0) + count
+        self.count += count
+        if len(store) > self.max_buckets:
+            self._collapse(store)
+
+    def merge(self, other):
+        """Add all the values counted by `other` to this sketch"""
+        for store, other_store in ((self._positive, other._positive),
+                                   (self._negative, other._negative)):
+            # Snapshot, in case `other` is being added to by another thread
+            for key, count in list(iteritems(other_store)):
+                store[key] = store.get(key, 0) + count
+            if len(store) > self.max_buckets:
+                self._collapse(store)
+        self._zero += other._zero
+        self.count += other.count
+
+    def _collapse(self, store):
+        """Fold the smallest magnitude buckets until `store` fits again"""
+        keys = sorted(store)
+        excess = len(keys) - self.max_buckets
+        target = keys[excess]
+        for key in keys[:excess]:
+            store[target] += store.pop(key)
+
+    def quantile(self, q):
+        """Returns the estimated value at quantile `q` (0.0 to 1.0)"""
+        if self.count == 0:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self._negative, reverse=True):
+            seen += self._negative[key]
+            if seen > rank:
+                return -self._value(key)
+
+        seen += self._zero
+        if seen > rank:
+            return 0.0
+
+        for key in sorted(self._positive):
+            seen += self._positive[key]
+            if seen > rank:
+                return self._value(key)
+
+        # Only reachable through floating point error on q=1.0, or a count
+        # updated by another thread, so return the largest value counted
+        if self._positive:
+            return self._value(max(self._positive))
+        if self._zero or not self._negative:
+            return 0.0
+        return -self._value(min(self._negative))
+
+
+class Percentile(_BaseCounter):
+    """A running percentile, estimated with a `QuantileSketch`"""
+
+    def __init__(self, quantile, suffix=None, name=None):
+        self.quantile = quantile
+        self.suffix = suffix or ('p%g' % (quantile * 100)).replace('.', '')
+        super(Percentile, self).__init__(name=name)
+
+    def _bind(self, obj):
+        return self.__class__(self.quantile, suffix=self.suffix,
+                              name=self.name)
+
+    def _initialize(self):
+        self._sketch = QuantileSketch()
+
+    def add(self, value):
+        self._sketch.add(value)
+
+    def merge(self, bucket):
+        self._sketch.merge(bucket.sketch)
+
+    def getvalue(self):
+        return self._sketch.quantile(self.quantile)
+
+
+def exponential_bounds(start, factor, count):
+    """Returns `count` histogram bucket bounds, `start` * `factor` ** N"""
+    return [start * factor ** i for i in range(count)]
+
+
+class BucketCounts(_BaseCounter):
+    """Running cumulative counts of values less than or equal to `bounds`
+
+    Values greater than all the `bounds` are only counted in the implicit
+    final "inf" bucket, whose count is the total number of values."""
+    suffix = 'bucket'
+
+    def __init__(self, bounds, name=None):
+        self.bounds = sorted(bounds)
+        super(BucketCounts, self).__init__(name=name)
+
+    def _bind(self, obj):
+        return self.__class__(self.bounds, name=self.name)
+
+    def _initialize(self):
+        self._counts = [0] * (len(self.bounds) + 1)
+
+    @staticmethod
+    def formatBound(bound):
+        return '%g' % bound
+
+    def add(self, value):
+        self._counts[bisect_left(self.bounds, value)] += 1
+
+    def merge(self, bucket):
+        for i, count in enumerate(bucket.counts):
+            self._counts[i] += count
+
+    def getvalue(self):
+        """Returns a list of (bound, cumulative count) tuples"""
+        result = []
+        total = 0
+        for bound, count in zip(self.bounds + ['inf'], self._counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def _genSampleValues(self, window, span):
+        for bound, count in self.getvalue():
+            if bound != 'inf':
+                bound = self.formatBound(bound)
+            yield self.suffix + '.' + bound, count
 
 
 # Lookup for mapping SampleTypes to their respective classes
@@ -169,29 +487,102 @@ _SampleMethod = {
     SampleType.AVERAGE: Average,
     SampleType.MAX: Max,
     SampleType.MIN: Min,
+    SampleType.RATE: Rate,
+    SampleType.P50: partial(Percentile, 0.50, SampleType.P50),
+    SampleType.P90: partial(Percentile, 0.90, SampleType.P90),
+    SampleType.P95: partial(Percentile, 0.95, SampleType.P95),
+    SampleType.P99: partial(Percentile, 0.99, SampleType.P99),
+    SampleType.P999: partial(Percentile, 0.999, SampleType.P999),
 }
 
 
+class _SampleBucket(object):
+    """Aggregate of every sample added during one `granularity` time slice"""
+    def __init__(self, slot, percentiles=False, bounds=None):
+        self.sketch = None
+        if percentiles:
+            self.sketch = QuantileSketch()
+        self.bounds = bounds
+        self.reset(slot)
+
+    def reset(self, slot):
+        self.slot = slot
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        if self.sketch is not None:
+            self.sketch.clear()
+        if self.bounds is not None:
+            self.counts = [0] * (len(self.bounds) + 1)
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if self.sketch is not None:
+            self.sketch.add(value)
+        if self.bounds is not None:
+            self.counts[bisect_left(self.bounds, value)] += 1
+
+
 class Samples(_Nameable, _Bindable, ProvidesCounters):
     """`samples` are used to generate series of counters dynamically
 
     This is so you can say, keep track of the average duration of some event for
     the last minute, hour, day, etc, and export these as 4 separate counters.
+
+    By default, every sample is kept for the largest window, which is exact,
+    but costs memory and read time proportional to the event rate.  Pass a
+    `granularity` (in seconds) to instead aggregate samples into a ring of
+    fixed time slices.  Windows are then rounded out to whole slices, but
+    memory and `getCounters()` cost depend only on `max_window / granularity`.
+
+    Pass `sharded=True` for samples added from many threads at once.  Each
+    thread then adds to its own private series, and the series are combined
+    by `getCounters()`.
     """
-    def __init__(self, types=None, windows=None, name=None):
+    bounds = None
+
+    def __init__(self, types=None, windows=None, name=None, granularity=None,
+                 sharded=False):
         super(Samples, self).__init__(name)
         self.types = types or [SampleType.AVERAGE]
         # minutely, hourly
         self.windows = sorted(windows or [60, 3600])
         self.max_window = max(self.windows)
+        self.granularity = granularity
+        self._percentiles = any(isinstance(op, Percentile)
+                                for op in self._makeOps())
+        self.sharded = sharded
         self.samples = deque()
+        self.buckets = None
+        self._shards = None
+        if granularity is not None:
+            self._nbuckets = int(math.ceil(self.max_window / granularity)) + 1
+        if sharded:
+            self._shards = _ThreadShards(self._makeShard)
+        elif granularity is not None:
+            self.buckets = [None] * self._nbuckets
         self.dirty = True
         self._prev_counters = {}
         self._prev_time = None
 
+    def _getKwargs(self):
+        """Returns the constructor kwargs needed to make a copy of this"""
+        return dict(types=self.types, windows=self.windows, name=self.name,
+                    granularity=self.granularity, sharded=self.sharded)
+
     def _bind(self, obj):
-        return self.__class__(types=self.types, windows=self.windows,
-                              name=self.name)
+        return self.__class__(**self._getKwargs())
+
+    def _makeShard(self):
+        kwargs = self._getKwargs()
+        kwargs.update(name=None, sharded=False)
+        return self.__class__(**kwargs)
 
     def _genCounterCallbacks(self):
         """Yield all the child counters."""
@@ -202,55 +593,106 @@ class Samples(_Nameable, _Bindable, ProvidesCounters):
         """Defined to allow unittest overriding"""
         return time.time()
 
+    def _slot(self, ts):
+        return int(ts // self.granularity)
+
     def add(self, value):
         now = self._now()
+        target = self
+        if self._shards is not None:
+            target = self._shards.get()
+
+        if self.granularity is not None:
+            target._addBucketed(now, value)
+        else:
+            target._addRaw(now, value)
+        self.dirty = True
+
+        # TODO: Handle "infinite" windows
+
+    def _addRaw(self, now, value):
         self.samples.append((now, value))
 
         # When adding samples, trim old ones.
         while now - self.max_window > self.samples[0][0]:
             self.samples.popleft()
-        self.dirty = True
 
-        # TODO: Handle "infinite" windows
+    def _addBucketed(self, now, value):
+        slot = self._slot(now)
+        index = slot % self._nbuckets
+        bucket = self.buckets[index]
+        if bucket is None:
+            bucket = _SampleBucket(slot, percentiles=self._percentiles,
+                                   bounds=self.bounds)
+            self.buckets[index] = bucket
+        elif bucket.slot != slot:
+            # This slot's previous contents have aged out of every window
+            bucket.reset(slot)
+        bucket.add(value)
+
+    def _makeOps(self):
+        return [_SampleMethod[type]() for type in self.types]
+
+    def reset(self):
+        """Forget all the samples added so far"""
+        self.samples = deque()
+        if self.buckets is not None:
+            self.buckets = [None] * self._nbuckets
+        if self._shards is not None:
+            for shard in self._shards:
+                shard.reset()
+        self.dirty = True
 
     def getCounters(self):
         if self.dirty is False and self._prev_time == int(self._now()):
             return self._prev_counters
 
-        ops = []
-        for type in self.types:
-            ops.append(_SampleMethod[type]())
-
         now = self._now()
-        genwindows = iter(self.windows)
-        window = next(genwindows)
-        result = {}
-        done = False
+        if self.granularity is not None:
+            if self._shards is None:
+                rings = [self.buckets]
+            else:
+                rings = [shard.buckets for shard in self._shards]
+            result = self._getBucketedCounters(now, rings)
+        else:
+            # Snapshot the samples, since they may be concurrently trimmed
+            if self._shards is None:
+                samples = list(self.samples)
+            else:
+                samples = sorted(chain.from_iterable(
+                    list(shard.samples) for shard in self._shards),
+                    key=itemgetter(0))
+            result = self._getRawCounters(now, reversed(samples))
 
-        def _saveCounterValues(window):
-            """Re-usable helper function for setting results and continuing"""
+        self._prev_counters = result
+        self._prev_time = int(now)
+        self.dirty = False
+        return result
 
-            prefix = ''
-            if self.name is not None:
-                prefix = self.name + '.'
+    def _saveCounterValues(self, result, ops, window, span=None):
+        """Re-usable helper function for setting results of a window"""
+        prefix = ''
+        if self.name is not None:
+            prefix = self.name + '.'
 
-            for op in ops:
-                result[prefix + op.suffix + '.' + str(window)] = \
-                    op.getvalue()
-            # Move to the next window
-            try:
-                return next(genwindows), False
-            except StopIteration:
-                # We exhausted all our windows
-                return None, True
-
-        for ts, value in reversed(self.samples):
+        for op in ops:
+            for suffix, value in op._genSampleValues(window, span or window):
+                result[prefix + suffix + '.' + str(window)] = value
+
+    def _getRawCounters(self, now, samples):
+        ops = self._makeOps()
+        genwindows = iter(self.windows)
+        window = next(genwindows, None)
+        result = {}
+
+        for ts, value in samples:
             # We exceeded the current window
-            while not done and now - window > ts:
-                # Save counter values
-                window, done = _saveCounterValues(window)
+            while window is not None and now - window > ts:
+                # Save counter values, and move to the next window
+                self._saveCounterValues(result, ops, window)
+                window = next(genwindows, None)
 
-            if done:
+            if window is None:
                 # TODO: "prune" any remaining samples
                 break
 
@@ -258,12 +700,32 @@ class Samples(_Nameable, _Bindable, ProvidesCounters):
                 op.add(value)
 
         # We exhausted the samples before the windows
-        while not done:
-            window, done = _saveCounterValues(window)
+        while window is not None:
+            self._saveCounterValues(result, ops, window)
+            window = next(genwindows, None)
+
+        return result
+
+    def _getBucketedCounters(self, now, rings):
+        ops = self._makeOps()
+        result = {}
+        slot = self._slot(now)
+        nbuckets = self._nbuckets
+
+        # Walk the ring from the newest slot back; each window includes every
+        # slice that overlaps it, so it spans back to its first slice's start.
+        for window in self.windows:
+            first = self._slot(now - window)
+            while slot >= first and slot > self._slot(now) - nbuckets:
+                for ring in rings:
+                    bucket = ring[slot % nbuckets]
+                    if bucket is not None and bucket.slot == slot:
+                        for op in ops:
+                            op.merge(bucket)
+                slot -= 1
+            span = now - first * self.granularity
+            self._saveCounterValues(result, ops, window, span)
 
-        self._prev_counters = result
-        self._prev_time = int(now)
-        self.dirty = False
         return result
 
     def getCounter(self, name, default=None):
@@ -277,3 +739,43 @@ class Samples(_Nameable, _Bindable, ProvidesCounters):
 
 
 samples = Samples
+
+
+class Histogram(Samples):
+    """`histogram`s are `samples` that also count values into fixed buckets
+
+    For each window, the cumulative count of values less than or equal to
+    each of `bounds` is exported as "<name>.bucket.<bound>.<window>", along
+    with a final "<name>.bucket.inf.<window>" bucket.  Unlike averages or
+    min/max, these counts can be summed across processes and hosts.
+    """
+    DEFAULT_BOUNDS = exponential_bounds(1, 2, 16)
+
+    def __init__(self, bounds=None, types=None, windows=None, name=None,
+                 granularity=None, sharded=False):
+        self.bounds = sorted(bounds or self.DEFAULT_BOUNDS)
+        super(Histogram, self).__init__(
+            types=types or [SampleType.COUNT, SampleType.SUM],
+            windows=windows, name=name, granularity=granularity,
+            sharded=sharded)
+
+    def _getKwargs(self):
+        kwargs = super(Histogram, self)._getKwargs()
+        kwargs['bounds'] = self.bounds
+        return kwargs
+
+    def _makeOps(self):
+        ops = super(Histogram, self)._makeOps()
+        ops.append(BucketCounts(self.bounds))
+        return ops
+
+    def iterkeys(self):
+        for key in super(Histogram, self).iterkeys():
+            yield key
+        bounds = [BucketCounts.formatBound(b) for b in self.bounds] + ['inf']
+        for bound in bounds:
+            for window in self.windows:
+                yield self.name + '.bucket.' + bound + '.' + str(window)
+
+
+histogram = Histogram
@@ -0,0 +1,127 @@
+# Copyright (c) 2014, Facebook, Inc.  All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+#
+"""Sparts module for computing when crontab-style schedules fire"""
+from datetime import datetime, timedelta
+
+import time
+
+
+_ALIASES = {
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+    '@monthly': '0 0 1 * *',
+    '@weekly': '0 0 * * 0',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@hourly': '0 * * * *',
+}
+
+_MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun',
+           'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+_WEEKDAYS = ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']
+
+# How far ahead to look for a match, before deciding there isn't one
+_MAX_YEARS = 5
+
+
+class CronSchedule(object):
+    """A crontab(5)-style "minute hour day-of-month month day-of-week" schedule
+
+    Fields may be `*`, numbers, ranges (`1-5`), steps (`*/15`, `0-30/10`) or
+    comma-separated lists of those.  Months and days of the week may also be
+    given by their (english, three letter) names, and @hourly, @daily etc.
+    are supported.  As in cron, if both the day of the month and of the week
+    are restricted, matching either is enough.  Times are in local time.
+    """
+    def __init__(self, expression):
+        self.expression = expression
+        fields = _ALIASES.get(expression.strip().lower(), expression).split()
+        if len(fields) != 5:
+            raise ValueError("Cron expression %r must have 5 fields" %
+                             expression)
+
+        self.minutes = self._parseField(fields[0], 0, 59)
+        self.hours = self._parseField(fields[1], 0, 23)
+        self.days = self._parseField(fields[2], 1, 31)
+        self.months = self._parseField(fields[3], 1, 12, _MONTHS, 1)
+        weekdays = self._parseField(fields[4], 0, 7, _WEEKDAYS)
+        # Both 0 and 7 are sunday
+        self.weekdays = set(d % 7 for d in weekdays)
+        self._any_day = fields[2].startswith('*')
+        self._any_weekday = fields[4].startswith('*')
+
+    def _parseField(self, text, lo, hi, names=None, first_name=0):
+        values = set()
+        for part in text.lower().split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/', 1)
+                step = self._parseValue(step, 1, hi)
+            if part == '*':
+                start, end = lo, hi
+            elif '-' in part:
+                start, end = part.split('-', 1)
+                start = self._parseValue(start, lo, hi, names, first_name)
+                end = self._parseValue(end, lo, hi, names, first_name)
+            else:
+                start = self._parseValue(part, lo, hi, names, first_name)
+                # "5/15" means every 15 from 5 on
+                end = hi if step > 1 else start
+            if start > end:
+                raise ValueError("Invalid range %r in cron expression %r" %
+                                 (part, self.expression))
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _parseValue(self, text, lo, hi, names=None, first_name=0):
+        if names is not None and text in names:
+            return names.index(text) + first_name
+        try:
+            value = int(text)
+        except ValueError:
+            raise ValueError("Invalid value %r in cron expression %r" %
+                             (text, self.expression))
+        if not lo <= value <= hi:
+            raise ValueError("%d is out of range (%d-%d) in cron expression "
+                             "%r" % (value, lo, hi, self.expression))
+        return value
+
+    def _dayMatches(self, t):
+        day = t.day in self.days
+        # datetime's weekdays start on monday, cron's on sunday
+        weekday = (t.weekday() + 1) % 7 in self.weekdays
+        if self._any_day:
+            return weekday
+        if self._any_weekday:
+            return day
+        return day or weekday
+
+    def next(self, after):
+        """Returns the first time this schedule fires after `after`
+
+        Both are `time.time()` timestamps."""
+        t = datetime.fromtimestamp(after).replace(second=0, microsecond=0)
+        t += timedelta(minutes=1)
+        limit = t.year + _MAX_YEARS
+        while t.year <= limit:
+            if t.month not in self.months:
+                # The first day of the next month
+                t = (t.replace(day=1, hour=0, minute=0) +
+                     timedelta(days=32)).replace(day=1)
+            elif not self._dayMatches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return time.mktime(t.timetuple())
+
+        raise ValueError("Cron expression %r never fires" % self.expression)
+
+    def __repr__(self):
+        return 'CronSchedule(%r)' % self.expression
@@ -7,10 +7,14 @@
 """Module for common base classes and helpers, such as options and counters"""
 from __future__ import absolute_import
 
+from bisect import bisect_left
 from collections import namedtuple
 from functools import partial
 from six import iteritems
 
+import re
+import threading
+
 
 class _Nameable(object):
     """Base class for attribute classes with automatically set `name` attribute"""
@@ -45,6 +49,105 @@ class ProvidesCounters(object):
         """Yields this item's (names, value) counter tuple(s)."""
         raise NotImplementedError()
 
+class _CounterDict(dict):
+    """dict of an object's counters that keeps `CounterRegistry`s in sync
+
+    Only item assignment and deletion are tracked."""
+    def __init__(self, *args, **kwargs):
+        super(_CounterDict, self).__init__(*args, **kwargs)
+        self._registries = []
+
+    def __setitem__(self, name, counter):
+        super(_CounterDict, self).__setitem__(name, counter)
+        for prefix, registry in self._registries:
+            registry._add(prefix + name, counter)
+
+    def __delitem__(self, name):
+        super(_CounterDict, self).__delitem__(name)
+        for prefix, registry in self._registries:
+            registry._remove(prefix + name)
+
+
+class CounterRegistry(object):
+    """Index of counters from many objects, by their full dotted names
+
+    Objects' counters are `attach`ed under a name prefix, and are then kept
+    up to date as counters are added to or removed from them, so that exact,
+    prefix and (repeated) regex lookups don't have to walk every object.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._names = []
+        self._regex_cache = {}
+
+    def attach(self, prefix, counters):
+        """Index all current and future `counters` as `prefix` + name"""
+        with self._lock:
+            counters._registries.append((prefix, self))
+        for name, counter in list(iteritems(counters)):
+            self._add(prefix + name, counter)
+
+    def detach(self, prefix, counters):
+        """Stop indexing `counters` that were `attach`ed with `prefix`"""
+        with self._lock:
+            if (prefix, self) not in counters._registries:
+                return
+            counters._registries.remove((prefix, self))
+        for name in list(counters):
+            self._remove(prefix + name)
+
+    def _add(self, name, counter):
+        with self._lock:
+            if name not in self._counters:
+                self._names.insert(bisect_left(self._names, name), name)
+                self._regex_cache.clear()
+            self._counters[name] = counter
+
+    def _remove(self, name):
+        with self._lock:
+            if self._counters.pop(name, None) is not None:
+                del self._names[bisect_left(self._names, name)]
+                self._regex_cache.clear()
+
+    def get(self, name, default=None):
+        return self._counters.get(name, default)
+
+    def getAll(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def getSelected(self, names):
+        return dict((name, self._counters[name]) for name in names
+                    if name in self._counters)
+
+    def getPrefix(self, prefix):
+        """Returns the counters whose names start with `prefix`"""
+        with self._lock:
+            i = bisect_left(self._names, prefix)
+            result = {}
+            while i < len(self._names) and \
+                    self._names[i].startswith(prefix):
+                result[self._names[i]] = self._counters[self._names[i]]
+                i += 1
+            return result
+
+    def getRegex(self, regex):
+        """Returns the counters whose whole names match `regex`, like fb303
+
+        Matching names are cached per `regex` until the registry changes."""
+        with self._lock:
+            names = self._regex_cache.get(regex)
+            if names is None:
+                matcher = re.compile('(?:%s)\\Z' % regex)
+                names = [name for name in self._names
+                         if matcher.match(name) is not None]
+                self._regex_cache[regex] = names
+        return self.getSelected(names)
+
+
+_UNSET = object()
+
 _AddArgArgs = namedtuple('_AddArgArgs', ['opts', 'kwargs'])
 
 class option(_Nameable):
@@ -73,6 +176,22 @@ class option(_Nameable):
         if obj is None:
             return self
 
+        # Sanitized values are cached per-instance until the next
+        # setOption()/setTaskOption() replaces the cache.  Hold a reference
+        # to the cache being filled, so a value read while an option is
+        # being set can't be stored in its replacement.
+        cache = getattr(obj, '_option_cache', None)
+        if cache is not None:
+            value = cache.get(self, _UNSET)
+            if value is not _UNSET:
+                return value
+
+        value = self._getValue(obj)
+        if cache is not None:
+            cache[self] = value
+        return value
+
+    def _getValue(self, obj):
         value = self._getter(obj)(self.name)
 
         # If the default is of a different type than the option requires,
@@ -143,6 +262,9 @@ class option(_Nameable):
         return name
 
 
+_SpartsMeta = namedtuple('_SpartsMeta', ['counters', 'options'])
+
+
 class _NameHelper(type):
     def __new__(cls, name, bases, attrs):
 
@@ -155,27 +277,38 @@ class _NameHelper(type):
             v.name = v._getNameForIdentifier(k)
         return super(_NameHelper, cls).__new__(cls, name, bases, attrs)
 
+    def __init__(cls, name, bases, attrs):
+        super(_NameHelper, cls).__init__(name, bases, attrs)
+
+        # Discover class-level counters and options once per class, instead
+        # of scanning dir(cls) each time an instance or parser is created.
+        # Attributes assigned to the class after its creation are not found.
+        counters = []
+        options = []
+        for k in dir(cls):
+            v = getattr(cls, k)
+            if isinstance(v, ProvidesCounters):
+                counters.extend(v._genCounterCallbacks())
+            if getattr(v, '_prepareForArgumentParser', None):
+                options.append(v)
+        cls._sparts_meta = _SpartsMeta(counters, options)
+
 
 _SpartsObjectBase = _NameHelper('_SpartsObjectBase', (object, ), {})
 
 class _SpartsObject(_SpartsObjectBase):
     def __new__(cls, *args, **kwargs):
         inst = super(_SpartsObject, cls).__new__(cls)
-        inst.counters = {}
-        #for k, v in iteritems(cls.__dict__):
+        inst._option_cache = {}
 
-        # Traverse all child objects and statically assign a callable
-        # reference to all child counters to the instance's counters dictionary.
+        # Statically assign a callable reference to all the class' child
+        # counters (discovered by `_NameHelper`) to the instance's counters
+        # dictionary.
         #
         # This is sort of implicitly broken for Callback counters, which are
         # defined after __new__ is called (e.g., during Task initialization)
         # TODO: Implement this in a better way.
-        for k in dir(cls):
-            v = getattr(cls, k)
-            if isinstance(v, ProvidesCounters):
-                for cn, cv in v._genCounterCallbacks():
-                    inst.counters[cn] = cv
-
+        inst.counters = _CounterDict(cls._sparts_meta.counters)
         return inst
 
     @classmethod
@@ -203,6 +336,10 @@ class _SpartsObject(_SpartsObjectBase):
 
         return self.counters.get(name, lambda: None)
 
+    def _clearOptionCache(self):
+        """Forget all cached `option` values (e.g., after they've been set)"""
+        self._option_cache = {}
+
     def getChild(self, name):
         return self.getChildren()[name]
 
@@ -239,9 +376,14 @@ def get_options(cls):
                        and adds the option to it.
                        (e.g. "foo.regfunc(ap)" registers the foo option on ap)
     """
+    meta = cls.__dict__.get('_sparts_meta')
+    if meta is not None:
+        candidates = meta.options
+    else:
+        candidates = [getattr(cls, k) for k in dir(cls)]
+
     ret = []
-    for k in dir(cls):
-        v = getattr(cls, k)
+    for v in candidates:
         preparefunc = getattr(v, '_prepareForArgumentParser', None)
         if not preparefunc:
             continue
@@ -61,15 +61,24 @@ class FB303HandlerTask(ThriftHandlerTask):
         messages.extend(self.service.getWarnings().values())
         return '\n'.join(messages)
 
-    def getCounters(self):
+    def _evaluateCounters(self, counters):
         result = {}
-        for k, v in iteritems(self.service.getCounters()):
+        for k, v in iteritems(counters):
             v = v()
             if v is None:
                 continue
             result[k] = int(v)
         return result
 
+    def getCounters(self):
+        return self._evaluateCounters(self.service.getCounters())
+
+    def getSelectedCounters(self, keys):
+        return self._evaluateCounters(self.service.getSelectedCounters(keys))
+
+    def getRegexCounters(self, regex):
+        return self._evaluateCounters(self.service.getRegexCounters(regex))
+
     def getCounter(self, name):
         result = self.service.getCounter(name)()
         if result is None:
@@ -6,14 +6,23 @@
 #
 from __future__ import absolute_import
 
-from concurrent.futures import Future
+from concurrent.futures import Future, ThreadPoolExecutor
 from six.moves import queue
 
-from sparts.counters import counter, samples, SampleType
+from sparts.counters import counter, samples, SampleType, CallbackCounter
+from sparts.cron import CronSchedule
 from sparts.sparts import option
 from sparts.timer import Timer
 from sparts.vtask import VTask, TryLater
-from threading import Event
+from threading import Condition, Event, Lock
+
+from collections import deque
+
+import heapq
+import itertools
+import math
+import random
+import time
 
 
 class PeriodicTask(VTask):
@@ -21,24 +30,112 @@ class PeriodicTask(VTask):
 
     You must either override the `INTERVAL` (seconds) class attribute, or
     pass a --{OPT_PREFIX}-interval in order for your task to run.
+
+    By default, each run starts `interval` seconds after the previous one
+    started, or right after it ended if it took longer.  Set `FIXED_RATE`
+    (or --{OPT_PREFIX}-fixed-rate) to start runs at multiples of `interval`
+    since the epoch instead, so that they don't drift, or set `CRON` (or
+    --{OPT_PREFIX}-cron) to a crontab-style expression to start them when
+    that fires.  In both cases, ticks that pass while the previous run is
+    still going are counted by `n_missed_ticks`, but for the last one, which
+    runs as soon as it can and is counted by `n_late_ticks`.  The first run
+    starts right away.  Set `JITTER` (or --{OPT_PREFIX}-jitter) to delay each
+    run, including the first, by a random amount of up to that many seconds,
+    so that replicas don't all run at once, even after restarting together.
+
+    Set `MAX_CONCURRENT` (or --{OPT_PREFIX}-max-concurrent) above 1 to run
+    each tick on a pool of that many threads instead, so that slow runs
+    overlap rather than hold up the next ones.  Ticks then start `interval`
+    seconds apart whatever the runs take.  `OVERLAP_POLICY` decides what
+    happens to a tick while that many are running: "skip" it, "queue" it
+    (up to `MAX_CONCURRENT` of them, then skip), or "coalesce" it with any
+    other tick already waiting.  Skipped and coalesced ticks are counted.
+    Runs that raise `TryLater` with an `after` are retried on the same pool
+    thread once that has passed, still counting towards `MAX_CONCURRENT`;
+    those without one are retried by the next tick.
+
+    Set `DEADLINE` (or --{OPT_PREFIX}-deadline) to count, and warn about,
+    runs that take longer than that many seconds, in `n_overruns`.  Queued
+    ticks that can't start within that long of their tick are dropped, and
+    counted in `n_expired_ticks`.
+
+    `trigger_now()` (or `execute_async(wake=True)`) runs `execute` without
+    waiting for the next tick, though no sooner than `MIN_TRIGGER_GAP` (or
+    --{OPT_PREFIX}-min-trigger-gap) seconds after the last run started.
+    Callers that trigger it before that run starts share its result.
+
+    Set `SHARED_SCHEDULER` to have a `PeriodicScheduler`'s pool of threads
+    run `execute` when it's due, instead of a thread of this task's own.
     """
     INTERVAL = None
+    FIXED_RATE = False
+    CRON = None
+    JITTER = 0.0
+    MAX_CONCURRENT = 1
+    OVERLAP_POLICY = 'skip'
+    DEADLINE = 0.0
+    MIN_TRIGGER_GAP = 1.0
+    SHARED_SCHEDULER = False
 
-    execute_duration_ms = samples(windows=[60, 240],
-       types=[SampleType.AVG, SampleType.MAX, SampleType.MIN])
+    execute_duration_ms = samples(windows=[60, 240], granularity=1,
+       types=[SampleType.AVG, SampleType.MAX, SampleType.MIN,
+              SampleType.P50, SampleType.P90, SampleType.P99])
     n_iterations = counter()
     n_slow_iterations = counter()
     n_try_later = counter()
+    n_missed_ticks = counter()
+    n_late_ticks = counter()
+    n_skipped_ticks = counter()
+    n_coalesced_ticks = counter()
+    n_expired_ticks = counter()
+    n_overruns = counter()
+    n_triggered = counter()
 
     interval = option(type=float, metavar='SECONDS',
                       default=lambda cls: cls.INTERVAL,
                       help='How often this task should run [%(default)s] (s)')
+    fixed_rate = option(action='store_true', type=bool,
+                        default=lambda cls: cls.FIXED_RATE,
+                        help='Run at multiples of the interval, rather than '
+                             'an interval after the previous run')
+    cron = option(metavar='EXPR', default=lambda cls: cls.CRON,
+                  help='Run on this crontab-style schedule, e.g., '
+                       '"*/5 * * * *", instead of at an interval '
+                       '[%(default)s]')
+    jitter = option(type=float, metavar='SECONDS',
+                    default=lambda cls: cls.JITTER,
+                    help='Delay each run by a random amount of up to this '
+                         'long [%(default)s] (s)')
+    max_concurrent = option(type=int, default=lambda cls: cls.MAX_CONCURRENT,
+                            help='Run up to this many executions at once, '
+                                 'rather than one after the other '
+                                 '[%(default)s]')
+    overlap_policy = option(choices=['skip', 'queue', 'coalesce'],
+                            default=lambda cls: cls.OVERLAP_POLICY,
+                            help='What to do with ticks while max-concurrent '
+                                 'executions are running. [%(default)s]')
+    deadline = option(type=float, metavar='SECONDS',
+                      default=lambda cls: cls.DEADLINE,
+                      help='Count executions that take longer than this as '
+                           'overruns, and drop queued ticks that wait longer '
+                           'than this.  0 disables [%(default)s] (s)')
+    min_trigger_gap = option(type=float, metavar='SECONDS',
+                             default=lambda cls: cls.MIN_TRIGGER_GAP,
+                             help='Wait at least this long after a run '
+                                  'started before running again when '
+                                  'triggered [%(default)s] (s)')
 
     def execute(self, context=None):
         """Override this to perform some custom action periodically."""
         self.logger.debug('execute')
 
-    def execute_async(self):
+    def execute_async(self, wake=False):
+        """Returns a `Future` for the result of the next run of `execute`
+
+        If `wake` is set, that run is started now, as with `trigger_now`."""
+        if wake:
+            return self.trigger_now()
+
         f = Future()
 
         if self.running:
@@ -53,63 +150,392 @@ class PeriodicTask(VTask):
 
         return f
 
+    def trigger_now(self):
+        """Runs `execute` as soon as `min_trigger_gap` allows, rather than
+        waiting for the next tick.  Returns a `Future` for its result."""
+        f = Future()
+        if not self.running:
+            f.set_exception(RuntimeError("Worker not running"))
+            return f
+
+        with self._trigger_lock:
+            first = not self._triggered
+            self._triggered.append(f)
+        if first:
+            # Later callers share the wakeup, and the run, with this one
+            self.n_triggered.increment()
+            if self.scheduler is not None:
+                self.scheduler.wake(self, self._last_start +
+                                    self.min_trigger_gap)
+            else:
+                self._wake_event.set()
+        return f
+
     def has_pending(self):
-        return self.__futures.qsize() > 0
+        return self.__futures.qsize() > 0 or len(self._triggered) > 0
+
+    @classmethod
+    def getDeps(cls):
+        deps = super(PeriodicTask, cls).getDeps()
+        if cls.SHARED_SCHEDULER:
+            deps = list(deps) + [PeriodicScheduler]
+        return deps
 
     def initTask(self):
         # Register an event that we can more smartly wait on in case shutdown
         # is requested while we would be `sleep()`ing
         self.stop_event = Event()
         self.__futures = queue.Queue()
+        # Futures from `trigger_now`, for the next run to start
+        self._triggered = []
+        self._trigger_lock = Lock()
+        self._wake_event = Event()
+        self._last_start = 0.0
+
+        self.scheduler = None
+        self._scheduled = False
+        if self.SHARED_SCHEDULER:
+            # The scheduler's threads run this task instead
+            self.LOOPLESS = True
+            self.scheduler = self.service.requireTask(
+                PeriodicScheduler.__name__)
 
         super(PeriodicTask, self).initTask()
 
-        assert self.interval is not None, \
-            "INTERVAL must be defined on %s or --%s-interval passed" % \
-            (self.name, self.name)
+        self._cron = None
+        if self.cron:
+            if self.fixed_rate:
+                raise ValueError("%s can't have both a cron schedule and a "
+                                 "fixed rate" % self.name)
+            self._cron = CronSchedule(self.cron)
+        else:
+            assert self.interval is not None, \
+                "INTERVAL must be defined on %s or --%s-interval passed" % \
+                (self.name, self.name)
+
+        # Pool of threads that ticks are dispatched to, when they may overlap
+        self._pool = None
+        if self.max_concurrent > 1:
+            if self.workers != 1:
+                raise ValueError("%s can't run concurrently on more than one "
+                                 "worker" % self.name)
+            self._pool = ThreadPoolExecutor(self.max_concurrent)
+        self._overlap_lock = Lock()
+        self._nrunning = 0
+        # Deadlines (or None) of the ticks waiting for a free thread
+        self._pending = deque()
+        self.counters['n_running'] = CallbackCounter(lambda: self._nrunning)
+
+    def start(self):
+        super(PeriodicTask, self).start()
+        if self.scheduler is not None:
+            self._scheduled = True
+            self.scheduler.add(self)
 
     def stop(self):
         self.stop_event.set()
+        self._wake_event.set()
+        if self.scheduler is not None:
+            self._scheduled = False
+            self.scheduler.remove(self)
         super(PeriodicTask, self).stop()
 
+    def join(self):
+        super(PeriodicTask, self).join()
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+
+    @property
+    def running(self):
+        if self.scheduler is not None:
+            return self._scheduled
+        return super(PeriodicTask, self).running
+
+    def getInterval(self):
+        """Returns how long to wait between runs, when not on a fixed-rate
+        or cron schedule.  Override this to vary it."""
+        return self.interval
+
     def _runloop(self):
+        if self._pool is not None:
+            return self._runTicker()
+
+        if self._sleep(self._firstDelay()):
+            return
         timer = Timer()
         timer.start()
+        due = timer.start_time
         while not self.service._stop:
             try:
-                result = self.execute()
-
-                # On a successful result, notify all blocked futures.
-                # Use pop like this to avoid race conditions.
-                while self.__futures.qsize():
-                    f = self.__futures.get()
-                    f.set_result(result)
-
+                self._executeAndNotify()
             except TryLater as e:
                 if self._handle_try_later(e):
                     return
 
                 continue
-            except Exception as e:
-                # On unhandled exceptions, set the exception on any async
-                # blocked execute calls.
-                while self.__futures.qsize():
-                    f = self.__futures.get()
-                    f.set_exception(e)
-                raise
-
-            self.n_iterations.increment()
-            self.execute_duration_ms.add(timer.elapsed * 1000)
-            to_sleep = self.interval - timer.elapsed
-            if to_sleep > 0:
-                if self.stop_event.wait(to_sleep):
-                    return
-            else:
-                self.n_slow_iterations.increment()
+
+            to_sleep, due = self._finishIteration(timer, due)
+            if self._sleep(to_sleep):
+                return
 
             timer.start()
 
+    def _runScheduled(self, due):
+        """Runs `execute` once for the `PeriodicScheduler`, `due` when it was
+
+        Returns how long to wait before running it again, and when that run
+        is due, or None if this task has stopped."""
+        if self.service._stop or not self._scheduled:
+            return None
+        if self._pool is not None:
+            self._tick()
+            now = time.time()
+            if due > now:
+                # Triggered early; the scheduled tick is still to come
+                return due - now, due
+            return self._nextTickAfter(due)
+
+        timer = Timer()
+        timer.start()
+        try:
+            self._executeAndNotify()
+        except TryLater as e:
+            self._log_try_later(e)
+            return e.after or 0.0, due
+        except Exception:
+            # Like an unhandled exception in one of this task's own threads
+            self._scheduled = False
+            self.logger.exception("Unhandled exception in %s", self.name)
+            self.service.shutdown()
+            return None
+
+        to_sleep, due = self._finishIteration(timer, due)
+        return max(0.0, to_sleep), due
+
+    def _runTicker(self):
+        """Dispatches ticks to the pool, from this task's own thread"""
+        due = time.time()
+        next_tick = due + self._firstDelay()
+        while not self.service._stop:
+            if self._sleep(next_tick - time.time()):
+                return
+            self._tick()
+            # Unless this tick was triggered early
+            if time.time() >= next_tick:
+                to_sleep, due = self._nextTickAfter(due)
+                next_tick = time.time() + to_sleep
+
+    def _firstDelay(self):
+        """Returns how long to wait before the first run"""
+        if self.jitter > 0:
+            return random.uniform(0, self.jitter)
+        return 0.0
+
+    def _sleep(self, timeout):
+        """Waits `timeout` seconds, or less if `trigger_now` is called
+
+        Returns True if this task is stopping."""
+        until = time.time() + timeout
+        while True:
+            remaining = until - time.time()
+            if remaining <= 0 or not self._wake_event.wait(remaining):
+                return self.stop_event.is_set()
+            self._wake_event.clear()
+            if self.stop_event.is_set():
+                return True
+            if self._triggered:
+                break
+
+        gap = min(self._last_start + self.min_trigger_gap, until) - \
+            time.time()
+        return gap > 0 and self.stop_event.wait(gap)
+
+    def _nextTickAfter(self, due):
+        """Returns how long to wait for the tick after the one `due` at
+        `due`, when runs don't wait for each other, and when it's due"""
+        now = time.time()
+        if self._cron is None and not self.fixed_rate:
+            due = max(due + self.getInterval(), now)
+        else:
+            due = self._nextDue(due, now)
+        to_sleep = due - now
+        if self.jitter > 0:
+            to_sleep += random.uniform(0, self.jitter)
+        return max(0.0, to_sleep), due
+
+    def _tick(self):
+        """Runs `execute` on the pool, or applies `overlap_policy` if
+        `max_concurrent` runs are in progress"""
+        deadline = None
+        if self.deadline > 0:
+            deadline = time.time() + self.deadline
+
+        with self._overlap_lock:
+            if self._nrunning < self.max_concurrent:
+                self._nrunning += 1
+            elif self.overlap_policy == 'queue' and \
+                    len(self._pending) < self.max_concurrent:
+                self._pending.append(deadline)
+                return
+            elif self.overlap_policy == 'coalesce' and self._pending:
+                # Whichever starts first covers this tick too
+                self._pending[0] = deadline
+                self.n_coalesced_ticks.increment()
+                return
+            elif self.overlap_policy == 'coalesce':
+                self._pending.append(deadline)
+                return
+            else:
+                self.n_skipped_ticks.increment()
+                return
+
+        self._pool.submit(self._runTicks, deadline)
+
+    def _runTicks(self, deadline):
+        """Runs the tick with `deadline` on a pool thread, then any that
+        were queued while it ran"""
+        while True:
+            if self.stop_event.is_set():
+                # Don't start queued ticks while stopping
+                pass
+            elif deadline is not None and time.time() > deadline:
+                self.n_expired_ticks.increment()
+            else:
+                self._runTick(deadline)
+
+            with self._overlap_lock:
+                if not self._pending:
+                    self._nrunning -= 1
+                    return
+                deadline = self._pending.popleft()
+
+    def _runTick(self, deadline):
+        timer = Timer()
+        timer.start()
+        while True:
+            try:
+                self._executeAndNotify()
+                break
+            except TryLater as e:
+                self._log_try_later(e)
+                if e.after is None:
+                    # The next tick is the retry
+                    return
+                if self.stop_event.wait(e.after):
+                    return
+                if deadline is not None and time.time() > deadline:
+                    self.n_expired_ticks.increment()
+                    return
+                timer.start()
+            except Exception:
+                self._scheduled = False
+                self.logger.exception("Unhandled exception in %s", self.name)
+                self.service.shutdown()
+                return
+
+        self.n_iterations.increment()
+        self.execute_duration_ms.add(timer.elapsed * 1000)
+        if self.interval and timer.elapsed > self.interval:
+            self.n_slow_iterations.increment()
+        if deadline is not None and time.time() > deadline:
+            self._countOverrun(timer.elapsed)
+
+    def _countOverrun(self, elapsed):
+        self.n_overruns.increment()
+        self.logger.warning("%s took %.2fs, over its %.2fs deadline",
+                            self.name, elapsed, self.deadline)
+
+    def _executeAndNotify(self):
+        """Runs `execute`, and resolves the futures from `execute_async`"""
+        self._last_start = time.time()
+        # Callers triggering it from now on need another run
+        with self._trigger_lock:
+            triggered, self._triggered = self._triggered, []
+        try:
+            result = self.execute()
+        except TryLater:
+            with self._trigger_lock:
+                self._triggered[:0] = triggered
+            raise
+        except Exception as e:
+            # On unhandled exceptions, set the exception on any async
+            # blocked execute calls.
+            while self.__futures.qsize():
+                f = self.__futures.get()
+                f.set_exception(e)
+            for f in triggered:
+                f.set_exception(e)
+            raise
+
+        # On a successful result, notify all blocked futures.
+        # Use pop like this to avoid race conditions.
+        while self.__futures.qsize():
+            f = self.__futures.get()
+            f.set_result(result)
+        for f in triggered:
+            f.set_result(result)
+
+    def _finishIteration(self, timer, due):
+        """Counts a successful iteration, that was `due` at `due`
+
+        Returns how long to sleep, and when the next iteration is due."""
+        self.n_iterations.increment()
+        self.execute_duration_ms.add(timer.elapsed * 1000)
+        if self.deadline > 0 and timer.elapsed > self.deadline:
+            self._countOverrun(timer.elapsed)
+        if self._cron is None and not self.fixed_rate:
+            to_sleep = self.getInterval() - timer.elapsed
+            due = None
+        else:
+            now = time.time()
+            due = self._nextDue(due or timer.start_time, now)
+            to_sleep = due - now
+
+        if to_sleep <= 0:
+            self.n_slow_iterations.increment()
+        elif self.jitter > 0:
+            to_sleep += random.uniform(0, self.jitter)
+        return to_sleep, due
+
+    def _nextTick(self, tick):
+        """Returns the first tick of the fixed-rate or cron schedule after
+        `tick`"""
+        if self._cron is not None:
+            return self._cron.next(tick)
+        return (math.floor(tick / self.interval) + 1) * self.interval
+
+    def _nextDue(self, due, now):
+        """Returns when the run after the one `due` at `due` is due, having
+        finished at `now`"""
+        if due > now:
+            # This run was triggered early; the scheduled one is still to come
+            return due
+        tick = self._nextTick(due)
+        if tick > now:
+            return tick
+
+        # Run the last tick that passed now, and skip the others
+        self.n_late_ticks.increment()
+        if self._cron is None:
+            latest = math.floor(now / self.interval) * self.interval
+            missed = int(round((latest - tick) / self.interval))
+        else:
+            missed = 0
+            latest = tick
+            tick = self._nextTick(latest)
+            while tick <= now:
+                missed += 1
+                latest = tick
+                tick = self._nextTick(latest)
+        if missed:
+            self.n_missed_ticks.incrementBy(missed)
+        return latest
+
     def _handle_try_later(self, e):
+        self._log_try_later(e)
+        return self.stop_event.wait(e.after)
+
+    def _log_try_later(self, e):
         self.n_try_later.increment()
         if e.after is not None:
             self.logger.debug("TryLater (%s) thrown.  Retrying in %.2fs",
@@ -117,4 +543,99 @@ class PeriodicTask(VTask):
         else:
             self.logger.debug("TryLater (%s) thrown.  Retrying now",
                 e.message)
-        return self.stop_event.wait(e.after)
+
+
+class PeriodicScheduler(VTask):
+    """Runs the `PeriodicTask`s that set `SHARED_SCHEDULER`, on a timer heap
+
+    Rather than each of those tasks sleeping in threads of their own,
+    `WORKERS` (or --{OPT_PREFIX}-workers) threads wait for whichever is due
+    next, and run it.  Each task still only runs on up to its own `workers`
+    threads at a time.  It is added to the service by the tasks using it.
+    """
+    WORKERS = 2
+
+    workers = option(type=int, default=lambda cls: cls.WORKERS,
+                     help='Number of threads to run the scheduled tasks on. '
+                          '[%(default)s]')
+
+    def initTask(self):
+        super(PeriodicScheduler, self).initTask()
+        # Heap of (due time, sequence, task, scheduled due time)
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = Condition()
+        # When tasks woken while running should run next
+        self._wakes = {}
+
+    def add(self, task):
+        """Starts running `task`, on up to `task.workers` threads at once"""
+        now = time.time()
+        for i in range(task.workers):
+            self.schedule(task, now + task._firstDelay(), now)
+
+    def remove(self, task):
+        """Stops running `task`, once any executions in progress finish"""
+        with self._cond:
+            self._heap = [entry for entry in self._heap
+                          if entry[2] is not task]
+            heapq.heapify(self._heap)
+            self._wakes.pop(task, None)
+
+    def schedule(self, task, when, due=None):
+        """Runs `task` at `when` (a `time.time()` timestamp)
+
+        `due` is when its schedule says it's due, before any delay, and
+        defaults to `when`."""
+        if due is None:
+            due = when
+        with self._cond:
+            heapq.heappush(self._heap, (when, next(self._seq), task, due))
+            self._cond.notify()
+
+    def wake(self, task, when):
+        """Runs `task` at `when`, if it's not due to run before then"""
+        with self._cond:
+            entries = [entry for entry in self._heap if entry[2] is task]
+            if not entries:
+                # It's running; run it again at `when` once it's done
+                self._wakes[task] = when
+                return
+            entry = min(entries)
+            if entry[0] <= when:
+                return
+            self._heap.remove(entry)
+            self._heap.append((when, next(self._seq), task, entry[3]))
+            heapq.heapify(self._heap)
+            self._cond.notify()
+
+    def stop(self):
+        super(PeriodicScheduler, self).stop()
+        with self._cond:
+            self._cond.notify_all()
+
+    def _runloop(self):
+        while not self.service._stop:
+            with self._cond:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                delay = self._heap[0][0] - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                when, seq, task, due = heapq.heappop(self._heap)
+
+            result = task._runScheduled(due)
+            if result is not None:
+                delay, due = result
+                with self._cond:
+                    # Unless it was removed while it was running
+                    when = time.time() + delay
+                    woken = self._wakes.pop(task, None)
+                    if woken is not None:
+                        when = min(when, woken)
+                    if task.running:
+                        heapq.heappush(self._heap, (when, next(self._seq),
+                                                    task, due))
+                        self._cond.notify()
@@ -5,6 +5,8 @@
 # of patent rights can be found in the PATENTS file in the same directory.
 #
 from .periodic import PeriodicTask
+from sparts.counters import CallbackCounter
+from sparts.sparts import option
 from threading import Event
 
 
@@ -14,19 +16,58 @@ class PollerTask(PeriodicTask):
     Simply override `fetch`, and the `onValueChanged()` method will be called
     with the old and new values.  Additionally, the `getValue()` method can
     be called by other tasks to block until the values are ready.
+
+    Set `ADAPTIVE` (or --{OPT_PREFIX}-adaptive) to poll less often while the
+    value stays the same: each fetch that returns an equal value multiplies
+    the interval by `BACKOFF`, up to `MAX_INTERVAL` seconds, and a change
+    sets it back to `INTERVAL`.  The `current_interval` counter exports it.
     """
+    ADAPTIVE = False
+    MAX_INTERVAL = None
+    BACKOFF = 2.0
+
+    adaptive = option(action='store_true', type=bool,
+                      default=lambda cls: cls.ADAPTIVE,
+                      help='Poll less often while the value stays the same')
+    max_interval = option(type=float, metavar='SECONDS',
+                          default=lambda cls: cls.MAX_INTERVAL,
+                          help='Longest interval to back off to, when '
+                               'adaptive [%(default)s] (s)')
+    backoff = option(type=float, default=lambda cls: cls.BACKOFF,
+                     help='What to multiply the interval by after each '
+                          'unchanged fetch, when adaptive [%(default)s]')
+
     def initTask(self):
         self.current_value = None
         self.fetched = Event()
         super(PollerTask, self).initTask()
 
+        if self.adaptive:
+            if self.max_interval is None:
+                raise ValueError("MAX_INTERVAL must be defined on %s or "
+                                 "--%s-max-interval passed to adapt its "
+                                 "interval" % (self.name, self.name))
+            if self.cron or self.fixed_rate:
+                raise ValueError("%s can't adapt the interval of a fixed "
+                                 "schedule" % self.name)
+        self.current_interval = self.interval
+        self.counters['current_interval'] = \
+            CallbackCounter(lambda: self.current_interval)
+
     def execute(self, context=None):
         new_value = self.fetch()
         if self.current_value != new_value:
             self.onValueChanged(self.current_value, new_value)
+            self.current_interval = self.interval
+        elif self.adaptive:
+            self.current_interval = min(self.current_interval * self.backoff,
+                                        self.max_interval)
         self.current_value = new_value
         self.fetched.set()
 
+    def getInterval(self):
+        return self.current_interval
+
     def onValueChanged(self, old_value, new_value):
         self.logger.debug('onValueChanged(%s, %s)', old_value, new_value)
 
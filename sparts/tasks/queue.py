@@ -5,92 +5,646 @@
 # of patent rights can be found in the PATENTS file in the same directory.
 #
 """Module for tasks related to doing work from a queue"""
-from concurrent.futures import Future
+from collections import deque
+from concurrent.futures import Future, wait, FIRST_COMPLETED, TimeoutError
+from multiprocessing import reduction
+from multiprocessing.connection import Connection
 from six.moves import queue
-from sparts.collections import PriorityQueue, UniqueQueue
+from sparts.collections import DurableQueue, PriorityQueue, Queue, \
+    UniqueQueue, WorkStealingQueue
 from sparts.counters import counter, samples, SampleType, CallbackCounter
 from sparts.sparts import option
-from sparts.vtask import VTask, ExecuteContext, TryLater
+from sparts.vtask import VTask, CompactExecuteContext, TryLater
+
+import heapq
+import itertools
+import multiprocessing
+import os
+import signal
+import threading
+import time
 
 
 class QueueTask(VTask):
-    """Task that calls `execute` for all work put on its `queue`"""
+    """Task that calls `execute` for all work put on its `queue`
+
+    Set `BATCH_SIZE` (or --{OPT_PREFIX}-batch-size) above 1 to have workers
+    instead pass up to that many items at a time to `execute_batch`, waiting
+    up to `BATCH_LINGER_MS` for a batch to fill up.
+
+    Work that raises `TryLater` is re-queued after its `after` delay or, if
+    `RETRY_BACKOFF` is set, after an exponentially increasing delay capped at
+    `RETRY_BACKOFF_MAX`.  Work is failed instead of retried once it has been
+    attempted `MAX_ATTEMPTS` times, if set.  Note that `queue.join()` does
+    not wait for delayed retries, and that work still waiting to be retried
+    when the task stops fails with `Stopped`.
+
+    Set `MAX_WORKERS` (or --{OPT_PREFIX}-max-workers) above `WORKERS` to
+    autoscale the worker threads: a worker is added whenever `queue_depth`
+    stays above `SCALE_UP_DEPTH` for `SCALE_UP_DELAY` seconds, and workers
+    that have been idle for `SCALE_DOWN_IDLE` seconds exit, down to
+    `MIN_WORKERS`.  If `SCALE_UP_WAIT_MS` is set, workers are also added
+    while the oldest item has been queued for longer than that.
+
+    Work queued through `submit`, `submit_nowait` and `put_many` is
+    timestamped, so the time it spends queued is measured by `queue_wait_ms`
+    and `oldest_item_age_ms`.  Items put directly on `queue` aren't.
+
+    When `MAX_ITEMS` bounds the queue, `OVERFLOW_POLICY` decides what
+    happens to work submitted while it is full: "block" until there is room
+    (for at most `OVERFLOW_TIMEOUT` seconds, if set), "reject" it right
+    away, or evict the oldest ("drop_oldest") or, for `PriorityQueueTask`s,
+    the lowest priority ("drop_lowest") item to make room for it.  Rejected
+    and evicted work fails with `queue.Full` (or its `Dropped` subclass).
+    Work submitted with a `deadline` fails with `DeadlineExceeded`, instead
+    of being executed, if it is dequeued after its deadline.
+
+    Set `SHARDED` (or --{OPT_PREFIX}-sharded) to give each worker its own
+    deque in a `WorkStealingQueue`, instead of having all of them contend on
+    one lock.  Work is spread round-robin, or by the hash of `shard_key`, and
+    idle workers steal from the others.  If `ORDER_BY_KEY` is also set, they
+    don't steal, so work with the same `shard_key` runs in order on the same
+    worker (but retries are queued behind it).  Sharded queues are
+    unbounded."""
     MAX_ITEMS = 0
     WORKERS = 1
+    BATCH_SIZE = 1
+    BATCH_LINGER_MS = 0
+    RETRY_BACKOFF = 0.0
+    RETRY_BACKOFF_MAX = 60.0
+    MAX_ATTEMPTS = 0
+    MIN_WORKERS = 1
+    MAX_WORKERS = 0
+    SCALE_UP_DEPTH = 0
+    SCALE_UP_DELAY = 1.0
+    SCALE_UP_WAIT_MS = 0
+    SCALE_DOWN_IDLE = 30.0
+    OVERFLOW_POLICY = 'block'
+    OVERFLOW_TIMEOUT = 0.0
+    SHARDED = False
+    ORDER_BY_KEY = False
+    CONTEXT_CLASS = CompactExecuteContext
     max_items = option(type=int, default=lambda cls: cls.MAX_ITEMS,
                        help='Set a bounded queue length.  This may '
-                            'cause unexpected deadlocks. [%(default)s]')
+                            'cause unexpected deadlocks with the "block" '
+                            'overflow policy. [%(default)s]')
+    overflow_policy = option(choices=['block', 'reject', 'drop_oldest',
+                                      'drop_lowest'],
+                             default=lambda cls: cls.OVERFLOW_POLICY,
+                             help='What to do with work submitted while the '
+                                  'queue is full. [%(default)s]')
+    overflow_timeout = option(type=float, metavar='SECONDS',
+                              default=lambda cls: cls.OVERFLOW_TIMEOUT,
+                              help='Reject work that the "block" overflow '
+                                   'policy waited this long to queue.  0 '
+                                   'waits forever. [%(default)s] (s)')
+    sharded = option(action='store_true', type=bool,
+                     default=lambda cls: cls.SHARDED,
+                     help='Give each worker its own queue, and have idle '
+                          'workers steal work from the others.')
     workers = option(type=int, default=lambda cls: cls.WORKERS,
                      help='Number of threads to spawn to work on items from '
                           'its queue. [%(default)s]')
+    batch_size = option(type=int, default=lambda cls: cls.BATCH_SIZE,
+                        help='Maximum number of items to pass to each '
+                             'execute_batch() call. [%(default)s]')
+    batch_linger_ms = option(type=float, metavar='MS',
+                             default=lambda cls: cls.BATCH_LINGER_MS,
+                             help='How long to wait for more items to fill '
+                                  'a batch. [%(default)s] (ms)')
+    retry_backoff = option(type=float, metavar='SECONDS',
+                           default=lambda cls: cls.RETRY_BACKOFF,
+                           help='Initial delay before retrying work that '
+                                'raised TryLater without `after`, doubled '
+                                'for each attempt. 0 retries immediately. '
+                                '[%(default)s] (s)')
+    retry_backoff_max = option(type=float, metavar='SECONDS',
+                               default=lambda cls: cls.RETRY_BACKOFF_MAX,
+                               help='Maximum retry backoff delay. '
+                                    '[%(default)s] (s)')
+    max_attempts = option(type=int, default=lambda cls: cls.MAX_ATTEMPTS,
+                          help='Fail work after this many attempts. 0 '
+                               'retries forever. [%(default)s]')
+    min_workers = option(type=int, default=lambda cls: cls.MIN_WORKERS,
+                         help='Minimum number of threads to keep when '
+                              'autoscaling. [%(default)s]')
+    max_workers = option(type=int, default=lambda cls: cls.MAX_WORKERS,
+                         help='Maximum number of threads to grow to when '
+                              'the queue backs up.  0 disables autoscaling. '
+                              '[%(default)s]')
+    scale_up_depth = option(type=int,
+                            default=lambda cls: cls.SCALE_UP_DEPTH,
+                            help='Add a worker when queue_depth stays above '
+                                 'this. [%(default)s]')
+    scale_up_delay = option(type=float, metavar='SECONDS',
+                            default=lambda cls: cls.SCALE_UP_DELAY,
+                            help='How long queue_depth must stay above '
+                                 'scale_up_depth before adding a worker, '
+                                 'and between additions. [%(default)s] (s)')
+    scale_up_wait_ms = option(type=float, metavar='MS',
+                              default=lambda cls: cls.SCALE_UP_WAIT_MS,
+                              help='Also add a worker when the oldest item '
+                                   'has been queued this long.  0 disables. '
+                                   '[%(default)s] (ms)')
+    scale_down_idle = option(type=float, metavar='SECONDS',
+                             default=lambda cls: cls.SCALE_DOWN_IDLE,
+                             help='Autoscaled workers exit after being idle '
+                                  'this long. [%(default)s] (s)')
 
-    execute_duration_ms = samples(windows=[60, 240],
-       types=[SampleType.AVG, SampleType.MAX, SampleType.MIN])
-    n_trylater = counter()
-    n_completed = counter()
-    n_unhandled = counter()
+    # Updated concurrently by all the workers, so shard them per-thread
+    execute_duration_ms = samples(windows=[60, 240], granularity=1,
+       types=[SampleType.AVG, SampleType.MAX, SampleType.MIN,
+              SampleType.P50, SampleType.P90, SampleType.P99], sharded=True)
+    queue_wait_ms = samples(windows=[60, 240], granularity=1,
+       types=[SampleType.AVG, SampleType.MAX,
+              SampleType.P50, SampleType.P90, SampleType.P99], sharded=True)
+    n_trylater = counter(sharded=True)
+    n_completed = counter(sharded=True, windows=[60, 600])
+    n_unhandled = counter(sharded=True)
+    n_retries_exhausted = counter(sharded=True)
+    n_rejected = counter(sharded=True)
+    n_timed_out = counter(sharded=True)
+    n_dropped = counter(sharded=True)
+    n_expired = counter(sharded=True)
+    n_scale_ups = counter()
+    n_scale_downs = counter()
 
     def execute(self, item, context):
         """Implement this in your QueueTask subclasses"""
         raise NotImplementedError()
 
+    def execute_batch(self, items, contexts):
+        """Override this to process `items` together, when batching is enabled
+
+        Must return a sequence with one result for each item.  Exception
+        instances in the results fail their respective item, or retry it if
+        it's a `TryLater`.  Raising fails (or retries) the whole batch.
+        By default, calls `execute` for each item."""
+        results = []
+        for item, context in zip(items, contexts):
+            try:
+                results.append(self.execute(item, context))
+            except Exception as ex:
+                results.append(ex)
+        return results
+
+    def _execute(self, item, context):
+        """Runs `execute` on behalf of the workers"""
+        return self.execute(item, context)
+
+    def _executeBatch(self, items, contexts):
+        """Runs `execute_batch` on behalf of the workers"""
+        return self.execute_batch(items, contexts)
+
+    def shard_key(self, item):
+        """Override this to put `item` on the sharded queue by key.
+
+        Returns None to put it on the next worker's deque, round-robin."""
+        return None
+
+    def _shardKey(self, item):
+        if isinstance(item, CompactExecuteContext):
+            item = item.item
+        return self.shard_key(item)
+
     def _makeQueue(self):
         """Override this if you need a custom Queue implementation"""
-        return queue.Queue(maxsize=self.max_items)
+        if self.sharded:
+            return WorkStealingQueue(max(self.workers, self.max_workers, 1),
+                                     key=self._shardKey,
+                                     ordered=self.ORDER_BY_KEY)
+        return Queue(maxsize=self.max_items)
 
     def initTask(self):
         super(QueueTask, self).initTask()
         self.queue = self._makeQueue()
         self.counters['queue_depth'] = \
             CallbackCounter(lambda: self.queue.qsize())
+        self.counters['oldest_item_age_ms'] = \
+            CallbackCounter(self._oldestItemAgeMs)
         self._shutdown_sentinel = object()
+        if self.max_items > 0 and self.overflow_policy.startswith('drop_') \
+                and self._evicts() not in getattr(self.queue, 'EVICTS', ()):
+            raise ValueError("%s can't %s items from its %s" %
+                             (self.name, self.overflow_policy,
+                              self.queue.__class__.__name__))
+        if self.sharded:
+            if not isinstance(self.queue, WorkStealingQueue):
+                raise ValueError("%s can't shard its %s" %
+                                 (self.name, self.queue.__class__.__name__))
+            if self.max_items > 0:
+                raise ValueError("%s can't bound its sharded queue" %
+                                 self.name)
+            if self.ORDER_BY_KEY and self.autoscaling:
+                raise ValueError("%s can't autoscale workers that own keys" %
+                                 self.name)
+
+        # Heap of (due time, sequence, context) for delayed retries.  Its
+        # thread is only started when the first delayed retry is scheduled.
+        self._retries = []
+        self._retry_seq = itertools.count()
+        self._retry_cond = threading.Condition()
+        self._retry_thread = None
+        self.counters['retries_pending'] = \
+            CallbackCounter(lambda: len(self._retries))
+
+        self._worker_lock = threading.Lock()
+        self._worker_seq = itertools.count(self.workers + 1)
+        self._nworkers = len(self.threads)
+        self.counters['n_workers'] = CallbackCounter(lambda: self._nworkers)
+        self._autoscale_event = threading.Event()
+        if self.autoscaling:
+            assert self.min_workers <= self.workers <= self.max_workers, \
+                "%s must have min_workers <= workers <= max_workers" % \
+                self.name
+            self.threads.append(threading.Thread(
+                target=self._runAutoscaler, name='%s-autoscaler' % self.name))
+
+    @property
+    def autoscaling(self):
+        """True if the number of workers varies with the queue's depth"""
+        return not self.LOOPLESS and self.max_workers > self.workers
 
     def stop(self):
         super(QueueTask, self).stop()
-        self.queue.put(self._shutdown_sentinel)
+        self._putSentinel()
+        self._autoscale_event.set()
+        with self._retry_cond:
+            self._retry_cond.notify()
+
+    def join(self):
+        # Workers may be added (or forgotten) meanwhile, so keep joining
+        # until there are no new threads
+        joined = set()
+        while True:
+            with self._worker_lock:
+                threads = [t for t in self.threads if t not in joined]
+            if not threads:
+                break
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.5)
+                joined.add(thread)
+
+        # Including any retries scheduled after the retry thread exited
+        self._dropRetries()
+
+    def submit(self, item, deadline=None):
+        """Enqueue `item` into this task's Queue.  Returns a `Future`
 
-    def submit(self, item):
-        """Enqueue `item` into this task's Queue.  Returns a `Future`"""
+        If `deadline` (a `time.time()` timestamp) passes before `item` is
+        dequeued, it isn't executed and the future fails instead."""
         future = Future()
-        work = ExecuteContext(item=item, future=future)
-        self.queue.put(work)
+        self._admit(self._enqueueContext(item, future, deadline=deadline))
         return future
 
+    def submit_nowait(self, item, deadline=None):
+        """Enqueue `item` without creating a `Future` for its result"""
+        self._admit(self._enqueueContext(item, deadline=deadline))
+
+    def put_many(self, items):
+        """Enqueue all `items` without futures, in one go if possible.
+
+        Queues from `_makeQueue` that implement `put_many` are locked once for
+        all the `items`, instead of once per item, unless they are bounded
+        with an overflow policy other than blocking forever."""
+        now = time.time()
+        contexts = [self._enqueueContext(item, now=now) for item in items]
+        put_many = getattr(self.queue, 'put_many', None)
+        if put_many is not None and self._blocksForever():
+            put_many(contexts)
+        else:
+            for context in contexts:
+                self._admit(context)
+
+    def _enqueueContext(self, item, future=None, now=None, deadline=None):
+        """Returns a `CONTEXT_CLASS` for `item`, timestamped as queued now"""
+        context = self.CONTEXT_CLASS(item=item, future=future)
+        context.enqueue_time = now or time.time()
+        context.deadline = deadline
+        return context
+
+    def _requeue(self, context):
+        """Puts `context` back on the queue, e.g., to retry it"""
+        context.enqueue_time = time.time()
+        self._admit(context)
+
+    def _blocksForever(self):
+        """True if puts wait for room in the queue for as long as it takes"""
+        return self.max_items <= 0 or \
+            (self.overflow_policy == 'block' and not self.overflow_timeout)
+
+    def _admit(self, context):
+        """Puts `context` on the queue, applying the `overflow_policy`"""
+        if self._blocksForever():
+            self.queue.put(context)
+            return
+
+        policy = self.overflow_policy
+        if policy == 'block':
+            try:
+                self.queue.put(context, timeout=self.overflow_timeout)
+            except queue.Full as ex:
+                self.n_timed_out.increment()
+                self._shed(context, ex, queued=False)
+        elif policy == 'reject':
+            try:
+                self.queue.put(context, block=False)
+            except queue.Full as ex:
+                self.n_rejected.increment()
+                self._shed(context, ex, queued=False)
+        else:
+            evicted = self.queue.put_evict(context, self._evicts(),
+                                           keep=self._shutdown_sentinel)
+            if evicted is not None:
+                self.n_dropped.increment()
+                self._shed(self._makeContext(evicted), Dropped(), queued=True)
+
+    def _evicts(self):
+        """Returns the `put_evict` kind of item the overflow_policy drops"""
+        return self.overflow_policy[len('drop_'):]
+
+    def _putSentinel(self):
+        """Wakes up a worker to shut down, ignoring the queue's maxsize"""
+        interrupt = getattr(self.queue, 'interrupt', None)
+        if interrupt is not None:
+            # e.g., WorkStealingQueues wake up all their workers at once
+            interrupt(self._shutdown_sentinel)
+            return
+
+        with self.queue.mutex:
+            self._insertSentinel()
+            self.queue.not_empty.notify()
+
+    def _insertSentinel(self):
+        """Adds the shutdown sentinel to the queue, holding its mutex"""
+        self.queue._put(self._shutdown_sentinel)
+
+    def _shed(self, context, exception, queued):
+        """Fails `context` without executing it.
+
+        Only work that was `queued` (and then evicted or dequeued) is done."""
+        if not context.set_exception(exception):
+            self.logger.debug("Shed %s (%r)", context.item, exception)
+        if queued:
+            self.work_done(context)
+
+    def _expired(self, context, now):
+        """Sheds the dequeued `context` if its deadline has passed"""
+        if context.deadline is None or now <= context.deadline:
+            return False
+
+        self.n_expired.increment()
+        self._shed(context, DeadlineExceeded(), queued=True)
+        return True
+
+    def _recordWait(self, context, now):
+        """Records how long the dequeued `context` spent in the queue"""
+        if context.enqueue_time is not None:
+            self.queue_wait_ms.add((now - context.enqueue_time) * 1000.0)
+
+    def _oldestItemAgeMs(self):
+        """Returns how long the oldest queued item has waited, if it's
+        timestamped and the queue implements `oldest_time`"""
+        oldest_time = getattr(self.queue, 'oldest_time', None)
+        if oldest_time is None:
+            return 0.0
+        oldest = oldest_time(self._enqueueTime)
+        if oldest is None:
+            return 0.0
+        return max(0.0, time.time() - oldest) * 1000.0
+
+    @staticmethod
+    def _enqueueTime(item):
+        return getattr(item, 'enqueue_time', None)
+
     def map(self, items, timeout=None):
         """Enqueues `items` into the queue"""
         futures = map(self.submit, items)
         return [f.result(timeout) for f in futures]
 
+    def _defaultWindow(self):
+        """Enough work in flight to keep every worker's next batch ready"""
+        return 2 * max(1, self.workers) * max(1, self.batch_size)
+
+    def imap(self, items, timeout=None, window=None):
+        """Yields the results for `items`, in order, as they complete.
+
+        Unlike `map`, at most `window` items are submitted but not yet
+        yielded at any time, so `items` may be an unbounded iterator.
+        `timeout` applies to waiting for each result."""
+        window = window or self._defaultWindow()
+        items = iter(items)
+        pending = deque()
+        for item in items:
+            pending.append(self.submit(item))
+            if len(pending) >= window:
+                yield pending.popleft().result(timeout)
+
+        while pending:
+            yield pending.popleft().result(timeout)
+
+    def imap_unordered(self, items, timeout=None, window=None):
+        """Like `imap`, but yields results in the order they complete."""
+        window = window or self._defaultWindow()
+        items = iter(items)
+        pending = set()
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < window:
+                try:
+                    pending.add(self.submit(next(items)))
+                except StopIteration:
+                    exhausted = True
+
+            if not pending:
+                return
+
+            done, pending = wait(pending, timeout=timeout,
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                raise TimeoutError()
+            for future in done:
+                yield future.result()
+
+    def _makeContext(self, item):
+        """Create a `CONTEXT_CLASS` for queued `item` if it isn't a context"""
+        if isinstance(item, CompactExecuteContext):
+            item.raw_wrapped = False
+            return item
+
+        context = self.CONTEXT_CLASS(item=item)
+        context.raw_wrapped = True
+        return context
+
     def _runloop(self):
+        batch_size = self.batch_size
+        idle_since = time.time()
         while not self.service._stop:
             try:
                 item = self.queue.get(timeout=1.0)
                 if item is self._shutdown_sentinel:
-                    self.queue.put(item)
+                    self._putSentinel()
                     break
             except queue.Empty:
+                if self._retireWorker(idle_since):
+                    break
                 continue
 
-            # Create an ExecuteContext if we didn't have one
-            if isinstance(item, ExecuteContext):
-                context = item
-                item = context.item
-                context.raw_wrapped = False
-            else:
-                context = ExecuteContext(item=item)
-                context.raw_wrapped = True
+            if batch_size > 1:
+                stopping = self._runBatch(item, batch_size)
+                idle_since = time.time()
+                if stopping:
+                    break
+                continue
+
+            context = self._makeContext(item)
+            item = context.item
+            now = time.time()
+            self._recordWait(context, now)
+            if self._expired(context, now):
+                self.queue.task_done()
+                continue
 
             try:
                 context.start()
-                result = self.execute(item, context)
+                result = self._execute(item, context)
                 self.work_success(context, result)
-            except TryLater:
-                self.work_retry(context)
+            except TryLater as ex:
+                self.work_retry(context, ex)
             except Exception as ex:
                 self.work_fail(context, ex)
 
             finally:
                 self.queue.task_done()
+                idle_since = time.time()
+
+    def _runBatch(self, first, batch_size):
+        """Collect a batch starting with `first`, and `execute_batch` it.
+
+        Returns True if the shutdown sentinel was found in the queue."""
+        stopping = False
+        batch = [first]
+        deadline = time.time() + self.batch_linger_ms / 1000.0
+        while len(batch) < batch_size:
+            try:
+                timeout = deadline - time.time()
+                if timeout > 0:
+                    item = self.queue.get(timeout=timeout)
+                else:
+                    item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if item is self._shutdown_sentinel:
+                self._putSentinel()
+                stopping = True
+                break
+            batch.append(item)
+
+        contexts = []
+        now = time.time()
+        for item in batch:
+            context = self._makeContext(item)
+            self._recordWait(context, now)
+            if self._expired(context, now):
+                self.queue.task_done()
+            else:
+                contexts.append(context)
+        if not contexts:
+            return stopping
+
+        try:
+            for context in contexts:
+                context.start()
+            results = self._executeBatch([c.item for c in contexts],
+                                         contexts)
+            if len(results) != len(contexts):
+                raise ValueError("execute_batch returned %d results for %d "
+                                 "items" % (len(results), len(contexts)))
+        except Exception as ex:
+            results = [ex] * len(contexts)
+
+        # Resolve every item before re-raising the first unhandled failure
+        unhandled = None
+        for context, result in zip(contexts, results):
+            try:
+                if isinstance(result, TryLater):
+                    self.work_retry(context, result)
+                elif isinstance(result, Exception):
+                    try:
+                        raise result
+                    except Exception as ex:
+                        self.work_fail(context, ex)
+                else:
+                    self.work_success(context, result)
+            except Exception as ex:
+                if unhandled is None:
+                    unhandled = ex
+            finally:
+                self.queue.task_done()
+
+        if unhandled is not None:
+            raise unhandled
+        return stopping
+
+    def _addWorker(self):
+        """Start another worker thread, unless there are `max_workers`"""
+        with self._worker_lock:
+            if self.service._stop or self._nworkers >= self.max_workers:
+                return False
+            self._nworkers += 1
+            thread = threading.Thread(
+                target=self._run,
+                name='%s-%d' % (self.name, next(self._worker_seq)))
+            # Forget about workers that have already exited
+            self.threads = [t for t in self.threads
+                            if t.ident is None or t.is_alive()]
+            self.threads.append(thread)
+            # Started holding the lock, so `join` never sees it unstarted
+            thread.start()
+
+        self.n_scale_ups.increment()
+        self.logger.debug("Scaling up to %d workers", self._nworkers)
+        return True
+
+    def _retireWorker(self, idle_since):
+        """Returns True if the calling idle worker should exit"""
+        if not self.autoscaling or \
+                time.time() - idle_since < self.scale_down_idle:
+            return False
+
+        with self._worker_lock:
+            if self._nworkers <= self.min_workers:
+                return False
+            self._nworkers -= 1
+
+        self.n_scale_downs.increment()
+        self.logger.debug("Scaling down to %d workers", self._nworkers)
+        return True
+
+    def _backedUp(self):
+        """Returns True if the queue is deep enough, or old enough, to scale"""
+        if self.queue.qsize() > self.scale_up_depth:
+            return True
+        return self.scale_up_wait_ms > 0 and \
+            self._oldestItemAgeMs() > self.scale_up_wait_ms
+
+    def _runAutoscaler(self):
+        """Adds workers while the queue stays backed up"""
+        backed_up_since = None
+        while not self.service._stop:
+            now = time.time()
+            if self._backedUp():
+                if backed_up_since is None:
+                    backed_up_since = now
+                elif now - backed_up_since >= self.scale_up_delay:
+                    self._addWorker()
+                    backed_up_since = now
+            else:
+                backed_up_since = None
+
+            self._autoscale_event.wait(min(self.scale_up_delay / 2, 1.0))
 
     def work_success(self, context, result):
         self.n_completed.increment()
@@ -98,11 +652,74 @@ class QueueTask(VTask):
         context.set_result(result)
         self.work_done(context)
 
-    def work_retry(self, context):
+    def work_retry(self, context, exception=None):
+        if self.max_attempts and context.attempt >= self.max_attempts:
+            self.n_retries_exhausted.increment()
+            self.logger.warning("Giving up on %s after %d attempts",
+                                context.item, context.attempt)
+            context.set_exception(exception or TryLater())
+            self.work_done(context)
+            return
+
         self.n_trylater.increment()
+        delay = self._retryDelay(context, exception)
         context.attempt += 1
         self.work_done(context)
-        self.queue.put(context)
+        if delay > 0:
+            self._scheduleRetry(context, delay)
+        else:
+            self._requeue(context)
+
+    def _retryDelay(self, context, exception):
+        """Returns how long to wait before retrying `context` (seconds)"""
+        if exception is not None and exception.after is not None:
+            return exception.after
+        if self.retry_backoff > 0:
+            return min(self.retry_backoff * 2 ** (context.attempt - 1),
+                       self.retry_backoff_max)
+        return 0
+
+    def _scheduleRetry(self, context, delay):
+        with self._retry_cond:
+            heapq.heappush(self._retries,
+                           (time.time() + delay, next(self._retry_seq),
+                            context))
+            if self._retry_thread is None:
+                self._retry_thread = threading.Thread(
+                    target=self._runRetries, name='%s-retries' % self.name)
+                with self._worker_lock:
+                    self.threads.append(self._retry_thread)
+                    self._retry_thread.start()
+            self._retry_cond.notify()
+
+    def _runRetries(self):
+        """Re-queues delayed retries once they are due"""
+        while not self.service._stop:
+            with self._retry_cond:
+                if not self._retries:
+                    self._retry_cond.wait(1.0)
+                    continue
+                delay = self._retries[0][0] - time.time()
+                if delay > 0:
+                    self._retry_cond.wait(min(delay, 1.0))
+                    continue
+                due, seq, context = heapq.heappop(self._retries)
+
+            try:
+                self._requeue(context)
+            except Exception as ex:
+                # e.g., UniqueQueue `Duplicate`s that were re-submitted
+                self.logger.exception("Unable to re-queue %s", context.item)
+                context.set_exception(ex)
+
+        self._dropRetries()
+
+    def _dropRetries(self):
+        """Fails the delayed retries still pending once the task stops"""
+        with self._retry_cond:
+            retries, self._retries = self._retries, []
+        for due, seq, context in retries:
+            self._shed(context, Stopped(), queued=False)
 
     def work_fail(self, context, exception):
         self.n_unhandled.increment()
@@ -116,11 +733,51 @@ class QueueTask(VTask):
         pass
 
 class PriorityQueueTask(QueueTask):
-    # TODO: There is a possible shutdown crash in python-3, when there is
-    # outstanding work in the queue, but the sentinel object is inserted:
-    # the sentinal object isn't generally of a comparable type.
+    """QueueTask that executes the work with the lowest `priority` first
+
+    Work with equal priorities is executed in the order it was queued.  Set
+    `PRIORITY_AGING` (or --{OPT_PREFIX}-priority-aging) to lower the
+    priority of queued work by that much per second, so it doesn't starve.
+    Work queued through `submit`, `submit_nowait` or `put_many` can be
+    re-prioritized with `update_priority`, or taken off the queue with
+    `remove`."""
+    PRIORITY_AGING = 0.0
+
+    priority_aging = option(type=float, metavar='PER_SECOND',
+                            default=lambda cls: cls.PRIORITY_AGING,
+                            help='How much to lower the priority of queued '
+                                 'work by, per second. [%(default)s]')
+
+    def priority(self, item):
+        """Override this to prioritize `item` by something other than itself
+
+        Must return a number if `priority_aging` is set."""
+        return item
+
+    def _priority(self, item):
+        if isinstance(item, CompactExecuteContext):
+            item = item.item
+        return self.priority(item)
+
     def _makeQueue(self):
-        return PriorityQueue(maxsize=self.max_items)
+        return PriorityQueue(maxsize=self.max_items, key=self._priority,
+                             aging=self.priority_aging)
+
+    def update_priority(self, item, priority=None):
+        """Re-prioritize queued `item`, to `priority` or its `priority()`
+
+        Raises ValueError if it isn't queued."""
+        self.queue.update_priority(self.CONTEXT_CLASS(item=item), priority)
+
+    def remove(self, item):
+        """Take queued `item` off the queue, and cancel its future
+
+        Raises ValueError if it isn't queued."""
+        context = self._makeContext(
+            self.queue.remove(self.CONTEXT_CLASS(item=item)))
+        if context.future is not None:
+            context.future.cancel()
+        self.work_done(context)
 
 
 class UniqueQueueTask(QueueTask):
@@ -129,9 +786,301 @@ class UniqueQueueTask(QueueTask):
         q.explicit_unsee = True
         return q
 
+    def _insertSentinel(self):
+        # Workers put the sentinel back after getting it, but it's not unseen
+        self.queue._seen.discard(self._shutdown_sentinel)
+        super(UniqueQueueTask, self)._insertSentinel()
+
     def work_done(self, context):
         super(UniqueQueueTask, self).work_done(context)
         if context.raw_wrapped:
             self.queue.unsee(context.item)
         else:
             self.queue.unsee(context)
+
+
+class DurableQueueTask(QueueTask):
+    """QueueTask whose queue is persisted in `QUEUE_PATH`, by a `DurableQueue`
+
+    Work, and its context (but not its future), must be picklable.  Work is
+    acknowledged once it's done, e.g., by `work_success`, and work that
+    wasn't is executed again when the task is next started with the same
+    --{OPT_PREFIX}-queue-path.  Work waiting to be retried stays on disk until
+    it's re-queued.  Unless `FSYNC` is False, submitting work waits for it
+    to be fsynced, along with any other work submitted meanwhile."""
+    QUEUE_PATH = None
+    SEGMENT_BYTES = DurableQueue.SEGMENT_BYTES
+    FSYNC = True
+
+    queue_path = option(metavar='DIR', default=lambda cls: cls.QUEUE_PATH,
+                        help='Directory to persist the queue in. '
+                             '[%(default)s]')
+
+    def _makeQueue(self):
+        if not self.queue_path:
+            raise ValueError("%s needs a queue_path" % self.name)
+        return DurableQueue(self.queue_path, maxsize=self.max_items,
+                            segment_bytes=self.SEGMENT_BYTES,
+                            fsync=self.FSYNC)
+
+    def initTask(self):
+        super(DurableQueueTask, self).initTask()
+        self._retrying = threading.local()
+
+    def join(self):
+        super(DurableQueueTask, self).join()
+        self.queue.close()
+
+    def work_retry(self, context, exception=None):
+        if self.max_attempts and context.attempt >= self.max_attempts:
+            super(DurableQueueTask, self).work_retry(context, exception)
+            return
+
+        # Re-queueing it acknowledges its previous record instead
+        self._retrying.context = context
+        try:
+            super(DurableQueueTask, self).work_retry(context, exception)
+        finally:
+            self._retrying.context = None
+
+    def _requeue(self, context):
+        # Its new record replaces the one it was got with
+        context.enqueue_time = time.time()
+        timeout = None
+        if not self._blocksForever():
+            timeout = 0.0
+            if self.overflow_policy == 'block':
+                timeout = self.overflow_timeout
+        got = self._got(context)
+        try:
+            self.queue.requeue(context, got, timeout=timeout)
+        except queue.Full as ex:
+            if self.overflow_policy == 'block':
+                self.n_timed_out.increment()
+            else:
+                self.n_rejected.increment()
+            self.queue.ack(got)
+            self._shed(context, ex, queued=False)
+
+    def work_done(self, context):
+        super(DurableQueueTask, self).work_done(context)
+        if getattr(self._retrying, 'context', None) is not context:
+            self._ack(context)
+
+    def _ack(self, context):
+        self.queue.ack(self._got(context))
+
+    def _got(self, context):
+        """Returns the object the queue returned for `context`: the raw
+        item, for raw items that were wrapped in a new context"""
+        if context.raw_wrapped:
+            return context.item
+        return context
+
+
+class Dropped(queue.Full):
+    """Raised for queued work evicted to make room for newer work"""
+
+
+class Stopped(Exception):
+    """Raised for work still waiting to be retried when its task stopped"""
+
+
+class DeadlineExceeded(Exception):
+    """Raised for work dequeued after the `deadline` it was submitted with"""
+
+
+class ProcessDied(Exception):
+    """Raised for work whose `ProcessQueueTask` child process exited"""
+
+
+class ProcessQueueTask(QueueTask):
+    """QueueTask that runs `execute` (or `execute_batch`) in child processes
+
+    Each worker thread feeds its own child process, so CPU-bound work isn't
+    serialized by the GIL.  Items, results and exceptions must be picklable.
+    Changes `execute` makes to the task's state are made in the child, and
+    are not seen by the service.
+
+    Children are forked by a "zygote" process, itself forked by `initTask`
+    before any of the service's threads start, so they can't inherit locks
+    held by other threads.
+
+    If a child exits while working on an item, or takes longer than
+    `CHILD_TIMEOUT` (or --{OPT_PREFIX}-child-timeout) seconds, if set, that
+    item fails with `ProcessDied` and a new child is forked for the next
+    one.  On shutdown, children finish their current item and exit, and are
+    killed if that takes longer than `CHILD_JOIN_TIMEOUT`.
+    """
+    CHILD_TIMEOUT = 0.0
+    CHILD_JOIN_TIMEOUT = 5.0
+
+    child_timeout = option(type=float, metavar='SECONDS',
+                           default=lambda cls: cls.CHILD_TIMEOUT,
+                           help='Kill child processes that take longer than '
+                                'this to execute an item.  0 waits forever. '
+                                '[%(default)s] (s)')
+
+    n_child_restarts = counter(sharded=True)
+    n_child_timeouts = counter(sharded=True)
+
+    def initTask(self):
+        super(ProcessQueueTask, self).initTask()
+        self._local = threading.local()
+
+        get_context = getattr(multiprocessing, 'get_context', None)
+        mp = multiprocessing
+        if get_context is not None:
+            mp = get_context('fork')
+
+        self._zygote_lock = threading.Lock()
+        self._zygote_conn, zygote_conn = mp.Pipe()
+        self._zygote = mp.Process(target=self._zygoteLoop,
+                                  args=(zygote_conn,),
+                                  name='%s-zygote' % self.name)
+        self._zygote.daemon = True
+        self._zygote.start()
+        zygote_conn.close()
+
+    def join(self):
+        super(ProcessQueueTask, self).join()
+        with self._zygote_lock:
+            try:
+                self._zygote_conn.send(None)
+            except (IOError, OSError):
+                pass
+        self._zygote.join(self.CHILD_JOIN_TIMEOUT)
+        if self._zygote.is_alive():
+            self._zygote.terminate()
+            self._zygote.join()
+        self._zygote_conn.close()
+
+    def _zygoteLoop(self, conn):
+        """Forks a child for each connection handle sent by worker threads"""
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # Let the kernel reap our children
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+        while True:
+            try:
+                if conn.recv() is None:
+                    return
+            except EOFError:
+                return
+
+            fd = reduction.recv_handle(conn)
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    conn.close()
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    self._childLoop(Connection(fd))
+                finally:
+                    os._exit(0)
+
+            os.close(fd)
+            conn.send(pid)
+
+    def _startChild(self):
+        conn, child_conn = multiprocessing.Pipe()
+        try:
+            with self._zygote_lock:
+                self._zygote_conn.send(True)
+                reduction.send_handle(self._zygote_conn, child_conn.fileno(),
+                                      self._zygote.pid)
+                pid = self._zygote_conn.recv()
+        finally:
+            child_conn.close()
+        self._local.conn = conn
+        self._local.pid = pid
+
+    def _stopChild(self, kill=False):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            return
+
+        # The child closes its end of the pipe when it exits
+        if not kill:
+            try:
+                conn.send(None)
+                kill = not conn.poll(self.CHILD_JOIN_TIMEOUT)
+            except (IOError, OSError):
+                pass
+        if kill:
+            self.logger.warning("Killing unresponsive child process %d",
+                                self._local.pid)
+            try:
+                os.kill(self._local.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        conn.close()
+        self._local.conn = None
+
+    def _childLoop(self, conn):
+        """Executes work sent by the parent's worker thread, until told not to"""
+        # Let the parent handle signals and shut us down gracefully
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                return
+            if message is None:
+                return
+
+            batch, items, attempts = message
+            contexts = [CompactExecuteContext(attempt=attempt, item=item)
+                        for item, attempt in zip(items, attempts)]
+            try:
+                if batch:
+                    result = list(self.execute_batch(items, contexts))
+                else:
+                    result = self.execute(items[0], contexts[0])
+                response = (True, result)
+            except Exception as ex:
+                response = (False, ex)
+
+            try:
+                conn.send(response)
+            except Exception as ex:
+                # Most likely, the result wasn't picklable
+                conn.send((False, Exception("Unable to send result: %r" % ex)))
+
+    def _callChild(self, batch, contexts):
+        if getattr(self._local, 'conn', None) is None:
+            self._startChild()
+
+        conn = self._local.conn
+        pid = self._local.pid
+        conn.send((batch, [c.item for c in contexts],
+                   [c.attempt for c in contexts]))
+        try:
+            if self.child_timeout > 0 and not conn.poll(self.child_timeout):
+                self._stopChild(kill=True)
+                self.n_child_timeouts.increment()
+                self.n_child_restarts.increment()
+                raise ProcessDied("Child process %d timed out after %.1fs" %
+                                  (pid, self.child_timeout))
+            success, value = conn.recv()
+        except (EOFError, IOError, OSError):
+            self._stopChild()
+            self.n_child_restarts.increment()
+            raise ProcessDied("Child process %d exited" % pid)
+
+        if not success:
+            raise value
+        return value
+
+    def _execute(self, item, context):
+        return self._callChild(False, [context])
+
+    def _executeBatch(self, items, contexts):
+        return self._callChild(True, contexts)
+
+    def _runloop(self):
+        try:
+            super(ProcessQueueTask, self)._runloop()
+        finally:
+            self._stopChild()
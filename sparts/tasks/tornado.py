@@ -73,7 +73,7 @@ class TornadoHTTPTask(TornadoTask):
     DEFAULT_HOST = ''
     DEFAULT_SOCK = ''
 
-    requests = counter()
+    requests = counter(windows=[60, 600])
     #latency = samples(windows=[60, 3600],
     #                  types=[SampleType.AVG, SampleType.MIN, SampleType.MAX])
 
@@ -26,7 +26,7 @@ from .compat import OrderedDict, captureWarnings
 
 from sparts import vtask
 from .deps import HAS_PSUTIL, HAS_DAEMONIZE
-from .sparts import _SpartsObject, option
+from .sparts import _SpartsObject, CounterRegistry, option
 
 from sparts import daemon
 
@@ -104,6 +104,10 @@ class VService(_SpartsObject):
         # Register exported values API
         self.exported_values = {}
 
+        # Index this service's and its tasks' counters by their full names
+        self.counter_registry = CounterRegistry()
+        self.counter_registry.attach('', self.counters)
+
         # Set start_time for aliveSince() calls
         self.start_time = time.time()
 
@@ -158,12 +162,15 @@ class VService(_SpartsObject):
 
         # Actually create the tasks
         self.tasks.create(self)
+        for t in self.tasks:
+            self.counter_registry.attach(t.name + '.', t.counters)
 
         # Call service initialization hook after tasks have been instantiated,
         # but before they've been initialized.
         self.initService()
 
-        # Initialize the tasks
+        # Initialize the tasks.  Skipped tasks are removed, which stops
+        # exporting their counters.
         self.tasks.init()
 
     def _handleShutdownSignals(self, signum, frame):
@@ -341,7 +348,13 @@ class VService(_SpartsObject):
         return getattr(self.options, name, default)
 
     def setOption(self, name, value):
+        """Sets option `name`.  Use this instead of setting `options` directly,
+        so cached `option` values are refreshed on this and its tasks."""
         setattr(self.options, name, value)
+        self._clearOptionCache()
+        for t in self.tasks:
+            if isinstance(t, vtask.VTask):
+                t._clearOptionCache()
 
     def getOptions(self):
         return self.options.__dict__
@@ -357,6 +370,24 @@ class VService(_SpartsObject):
     def getChildren(self):
         return dict((t.name, t) for t in self.tasks)
 
+    def getCounters(self):
+        return self.counter_registry.getAll()
+
+    def getCounter(self, name):
+        counter = self.counter_registry.get(name)
+        if counter is None:
+            return super(VService, self).getCounter(name)
+        return counter
+
+    def getSelectedCounters(self, names):
+        return self.counter_registry.getSelected(names)
+
+    def getRegexCounters(self, regex):
+        return self.counter_registry.getRegex(regex)
+
+    def getCountersWithPrefix(self, prefix):
+        return self.counter_registry.getPrefix(prefix)
+
     def getWarnings(self):
         return self.warnings
 
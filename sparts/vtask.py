@@ -14,6 +14,7 @@ from __future__ import absolute_import
 import logging
 import six
 import threading
+import time
 
 from six.moves import xrange
 from sparts.sparts import _SpartsObject
@@ -134,7 +135,12 @@ class VTask(_SpartsObject):
                        self._optName(opt), default)
 
     def setTaskOption(self, opt, value):
-        setattr(self.service.options, self._optName(opt), value)
+        self.service.setOption(self._optName(opt), value)
+
+    @classmethod
+    def getDeps(cls):
+        """Returns the `VTask` subclasses that must be initialized first"""
+        return cls.DEPS
 
     @classmethod
     def register(cls):
@@ -165,30 +171,56 @@ class TryLater(Exception):
         self.after = after
 
 
-class ExecuteContext(object):
+class CompactExecuteContext(object):
     """An abstraction used internally by various tasks to track work
 
     Encapsulates common metrics for work that can be retried later, hooks for
-    signalling completion, etc"""
+    signalling completion, etc.
+
+    This is the lightweight variant used by `QueueTask`s for their work: it
+    uses `__slots__` and raw timestamps, rather than allocating an `Event`
+    and a `Timer` for every item.  Use `ExecuteContext` if you need those.
+    """
+    __slots__ = ('attempt', 'item', 'deferred', 'future', 'deadline',
+                 'enqueue_time', 'start_time', 'end_time', 'raw_wrapped',
+                 '__weakref__')
+
     def __init__(self, attempt=1, item=None, deferred=None, future=None):
         self.attempt = attempt
         self.item = item
         self.deferred = deferred
         self.future = future
-        self.running = threading.Event()
-        self.timer = Timer()
+        self.deadline = None
+        self.enqueue_time = self.start_time = self.end_time = None
+        self.raw_wrapped = False
+
+    def __getstate__(self):
+        # Futures and deferreds belong to this process, so they aren't
+        # pickled, e.g., by a `DurableQueue`
+        return dict((name, getattr(self, name))
+                    for name in CompactExecuteContext.__slots__
+                    if name not in ('deferred', 'future', '__weakref__'))
+
+    def __setstate__(self, state):
+        self.__init__()
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @property
+    def started(self):
+        """True once execution has started (on any attempt)"""
+        return self.start_time is not None
 
     def start(self):
         """Indicate that execution has started"""
-        if not self.running.is_set():
+        if self.start_time is None:
             if self.future is not None:
                 self.future.set_running_or_notify_cancel()
-            self.timer.start()
-            self.running.set()
+            self.start_time = time.time()
 
     def set_result(self, result):
         """Indicate that execution has completed"""
-        self.timer.stop()
+        self.end_time = time.time()
         if self.future is not None:
             self.future.set_result(result)
         if self.deferred is not None:
@@ -198,7 +230,7 @@ class ExecuteContext(object):
         """Indicate that execution has failed"""
         handled = False
 
-        self.timer.stop()
+        self.end_time = time.time()
         if self.future is not None:
             self.future.set_exception(exception)
 
@@ -220,8 +252,12 @@ class ExecuteContext(object):
 
     @property
     def elapsed(self):
-        """Convenience property.  Returns timer duration."""
-        return self.timer.elapsed
+        """Returns the duration since execution started, until it ended."""
+        if self.start_time is None:
+            return 0.0
+        if self.end_time is None:
+            return time.time() - self.start_time
+        return self.end_time - self.start_time
 
     @staticmethod
     def _unhandledErrback(error, unhandled):
@@ -232,28 +268,66 @@ class ExecuteContext(object):
     def __cmp__(self, obj):
         """Custom comparators for comparing contexts' work `item`s"""
         lhs, rhs = id(self), obj
-        if isinstance(obj, ExecuteContext):
+        if isinstance(obj, CompactExecuteContext):
             lhs, rhs = self.item, obj.item
 
         return cmp(lhs, rhs)
 
     def __lt__(self, obj):
         """Override __lt__ explicitly for priority queue implementations"""
-        assert isinstance(obj, ExecuteContext)
+        assert isinstance(obj, CompactExecuteContext)
         return self.item < obj.item
 
     def __eq__(self, obj):
-        assert isinstance(obj, ExecuteContext)
+        assert isinstance(obj, CompactExecuteContext)
         return self.item == obj.item
 
     def __ne__(self, obj):
-        assert isinstance(obj, ExecuteContext)
+        assert isinstance(obj, CompactExecuteContext)
         return self.item != obj.item
 
     def __gt__(self, obj):
-        assert isinstance(obj, ExecuteContext)
+        assert isinstance(obj, CompactExecuteContext)
         return self.item > obj.item
 
+    def __hash__(self):
+        """Hash like the work `item`, consistently with `__eq__`"""
+        return hash(self.item)
+
+
+class ExecuteContext(CompactExecuteContext):
+    """`CompactExecuteContext` with a `running` Event and a `timer`
+
+    `running` can be waited on for execution to start."""
+    def __init__(self, attempt=1, item=None, deferred=None, future=None):
+        super(ExecuteContext, self).__init__(attempt=attempt, item=item,
+                                             deferred=deferred, future=future)
+        self.running = threading.Event()
+        self.timer = Timer()
+
+    def start(self):
+        """Indicate that execution has started"""
+        if not self.running.is_set():
+            super(ExecuteContext, self).start()
+            self.timer.start()
+            self.running.set()
+
+    def set_result(self, result):
+        """Indicate that execution has completed"""
+        self.timer.stop()
+        super(ExecuteContext, self).set_result(result)
+
+    def set_exception(self, exception):
+        """Indicate that execution has failed"""
+        self.timer.stop()
+        return super(ExecuteContext, self).set_exception(exception)
+
+    @property
+    def elapsed(self):
+        """Convenience property.  Returns timer duration."""
+        return self.timer.elapsed
+
+
 class Tasks(object):
     """Collection class for dealing with service tasks.
 
@@ -278,7 +352,7 @@ class Tasks(object):
         name = task_class.__name__
         if name not in self._registered_names:
             # Recursively register dependencies
-            for dep in task_class.DEPS:
+            for dep in task_class.getDeps():
                 self.register(dep)
 
             self._registered.append(task_class)
@@ -315,6 +389,11 @@ class Tasks(object):
         self._created.remove(task)
         del(self._created_names[task.name])
 
+        # Stop exporting the removed task's counters from its service
+        registry = getattr(task.service, 'counter_registry', None)
+        if registry is not None:
+            registry.detach(task.name + '.', task.counters)
+
     def init(self):
         """Initialize all created tasks.  Remove ones that throw SkipTask."""
         assert self._did_create
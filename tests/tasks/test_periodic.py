@@ -4,9 +4,10 @@
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
 #
+from sparts.tasks import periodic
 from sparts.tasks.periodic import PeriodicTask
-from sparts.tests.base import SingleTaskTestCase
-from sparts.timer import Timer
+from sparts.tests.base import SingleTaskTestCase, MultiTaskTestCase
+from sparts.timer import Timer, run_until_true
 from sparts.vtask import TryLater
 
 import time
@@ -111,3 +112,242 @@ class TestMultiTask(SingleTaskTestCase):
             while len(self.task.visit_threads) < 5 and t.elapsed < 3.0:
                 time.sleep(0.101)
         self.assertGreaterEqual(self.task.counter, 5)
+
+
+class MySharedTask(MyTask):
+    SHARED_SCHEDULER = True
+
+
+class MyOtherSharedTask(MySharedTask):
+    pass
+
+
+class TestSharedScheduler(MultiTaskTestCase):
+    TASKS = [MySharedTask, MyOtherSharedTask]
+
+    def test_shared_threads(self):
+        scheduler = self.service.requireTask('PeriodicScheduler')
+        tasks = [self.requireTask(t.__name__) for t in self.TASKS]
+        for task in tasks:
+            self.assertEqual(task.threads, [])
+            self.assertTrue(task.running)
+            self.assertGreater(task.execute_async().result(3.0), 0)
+
+        # Both ran on the scheduler's threads
+        scheduler_threads = set(t.ident for t in scheduler.threads)
+        for task in tasks:
+            self.assertTrue(task.visit_threads <= scheduler_threads)
+
+    def test_trylater(self):
+        task = self.requireTask('MySharedTask')
+        n_try_later = task.n_try_later()
+        task.trylater = 0.01
+        run_until_true(lambda: task.n_try_later() > n_try_later, 3.0)
+        task.trylater = None
+        self.assertGreater(task.execute_async().result(3.0), 0)
+
+    def test_stop(self):
+        task = self.requireTask('MySharedTask')
+        task.stop()
+        self.assertFalse(task.running)
+        counter = task.counter
+        time.sleep(0.2)
+        self.assertLessEqual(task.counter, counter + 1)
+        with self.assertRaises(RuntimeError):
+            task.execute_async().result(1.0)
+
+
+class MyFixedRateTask(PeriodicTask):
+    INTERVAL = 0.1
+    FIXED_RATE = True
+
+    def initTask(self):
+        super(MyFixedRateTask, self).initTask()
+        self.starts = []
+
+    def execute(self):
+        self.starts.append(time.time())
+        if len(self.starts) == 4:
+            # Overrun a few ticks
+            time.sleep(0.35)
+
+
+class TestFixedRate(SingleTaskTestCase):
+    TASK = MyFixedRateTask
+
+    def test_fixed_rate(self):
+        run_until_true(lambda: len(self.task.starts) >= 2, 3.0)
+        n_late = self.task.n_late_ticks()
+        n_missed = self.task.n_missed_ticks()
+        run_until_true(lambda: len(self.task.starts) >= 7, 3.0)
+
+        # The first run is immediate, and the one after the overrun is late
+        starts = self.task.starts[1:3] + self.task.starts[5:7]
+        for start in starts:
+            self.assertLess(start % 0.1, 0.05)
+        self.assertEqual(self.task.n_late_ticks() - n_late, 1)
+        self.assertGreaterEqual(self.task.n_missed_ticks() - n_missed, 2)
+
+
+class MyConcurrentTask(PeriodicTask):
+    INTERVAL = 0.05
+    MAX_CONCURRENT = 2
+
+    def initTask(self):
+        super(MyConcurrentTask, self).initTask()
+        self.lock = threading.Lock()
+        self.concurrent = 0
+        self.max_seen = 0
+
+    def execute(self):
+        with self.lock:
+            self.concurrent += 1
+            self.max_seen = max(self.max_seen, self.concurrent)
+        time.sleep(0.2)
+        with self.lock:
+            self.concurrent -= 1
+
+
+class TestConcurrent(SingleTaskTestCase):
+    TASK = MyConcurrentTask
+
+    def test_skip(self):
+        n_skipped = self.task.n_skipped_ticks()
+        run_until_true(lambda: self.task.n_iterations() >= 4, 3.0)
+        self.assertEqual(self.task.max_seen, 2)
+        self.assertGreater(self.task.n_skipped_ticks() - n_skipped, 0)
+
+
+class MyCoalescingTask(MyConcurrentTask):
+    OVERLAP_POLICY = 'coalesce'
+    DEADLINE = 0.1
+
+
+class TestCoalescing(SingleTaskTestCase):
+    TASK = MyCoalescingTask
+
+    def test_coalesce(self):
+        n_coalesced = self.task.n_coalesced_ticks()
+        n_overruns = self.task.n_overruns()
+        run_until_true(lambda: self.task.n_iterations() >= 4, 3.0)
+        self.assertEqual(self.task.max_seen, 2)
+        self.assertGreater(self.task.n_coalesced_ticks() - n_coalesced, 0)
+        self.assertGreater(self.task.n_overruns() - n_overruns, 0)
+
+
+class MyQueueingTask(MyConcurrentTask):
+    OVERLAP_POLICY = 'queue'
+    DEADLINE = 0.1
+
+
+class TestQueueing(SingleTaskTestCase):
+    TASK = MyQueueingTask
+
+    def test_expire(self):
+        n_expired = self.task.n_expired_ticks()
+        # Queued ticks expire, rather than start late
+        run_until_true(
+            lambda: self.task.n_expired_ticks() - n_expired > 0, 3.0)
+        self.assertEqual(self.task.max_seen, 2)
+
+
+class MyTriggeredTask(PeriodicTask):
+    INTERVAL = 60.0
+    MIN_TRIGGER_GAP = 0.2
+
+    def initTask(self):
+        super(MyTriggeredTask, self).initTask()
+        self.starts = []
+
+    def execute(self):
+        self.starts.append(time.time())
+        time.sleep(0.05)
+        return len(self.starts)
+
+
+class TestTriggerNow(SingleTaskTestCase):
+    TASK = MyTriggeredTask
+
+    def test_trigger_now(self):
+        run_until_true(lambda: len(self.task.starts) >= 1, 3.0)
+        n_runs = len(self.task.starts)
+
+        # Concurrent callers share one run, well before the next tick
+        futures = [self.task.trigger_now() for i in range(5)]
+        results = set(f.result(3.0) for f in futures)
+        self.assertEqual(results, set([n_runs + 1]))
+
+        # ...which doesn't start within the minimum gap of the last one
+        result = self.task.execute_async(wake=True).result(3.0)
+        self.assertEqual(result, n_runs + 2)
+        self.assertGreaterEqual(self.task.starts[-1] - self.task.starts[-2],
+                                0.2)
+
+
+class MySharedTriggeredTask(MyTriggeredTask):
+    SHARED_SCHEDULER = True
+
+
+class TestSharedTriggerNow(MultiTaskTestCase):
+    TASKS = [MySharedTriggeredTask]
+
+    def test_trigger_now(self):
+        task = self.requireTask('MySharedTriggeredTask')
+        run_until_true(lambda: len(task.starts) >= 1, 3.0)
+        n_runs = len(task.starts)
+        futures = [task.trigger_now() for i in range(5)]
+        results = set(f.result(3.0) for f in futures)
+        self.assertEqual(results, set([n_runs + 1]))
+        self.assertEqual(task.trigger_now().result(3.0), n_runs + 2)
+
+
+class MyJitteredTask(MyTriggeredTask):
+    JITTER = 0.5
+
+
+class TestJitteredStart(SingleTaskTestCase):
+    TASK = MyJitteredTask
+
+    def setUp(self):
+        self.uniform = self.mock.patch.object(periodic.random, 'uniform',
+                                              return_value=0.2)
+        self.uniform.start()
+        self.started = time.time()
+        super(TestJitteredStart, self).setUp()
+
+    def tearDown(self):
+        super(TestJitteredStart, self).tearDown()
+        self.uniform.stop()
+
+    def test_first_run_jittered(self):
+        run_until_true(lambda: self.task.starts, 3.0)
+        self.assertGreaterEqual(self.task.starts[0] - self.started, 0.2)
+
+
+class MySharedJitteredTask(MyJitteredTask):
+    SHARED_SCHEDULER = True
+
+
+class TestSharedJitteredStart(TestJitteredStart):
+    TASK = MySharedJitteredTask
+
+
+class MyConcurrentTryLaterTask(MyTriggeredTask):
+    MAX_CONCURRENT = 2
+
+    def execute(self):
+        self.starts.append(time.time())
+        if len(self.starts) == 1:
+            raise TryLater(after=0.1)
+        return len(self.starts)
+
+
+class TestConcurrentTryLater(SingleTaskTestCase):
+    TASK = MyConcurrentTryLaterTask
+
+    def test_trylater_after(self):
+        # Retried after 0.1s, rather than on the next tick, in 60s
+        run_until_true(lambda: len(self.task.starts) >= 2, 3.0)
+        self.assertGreaterEqual(self.task.starts[1] - self.task.starts[0],
+                                0.1)
+        run_until_true(lambda: self.task.n_iterations() == 1, 1.0)
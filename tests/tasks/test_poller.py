@@ -6,6 +6,7 @@
 #
 from sparts.tasks.poller import PollerTask
 from sparts.tests.base import SingleTaskTestCase
+from sparts.timer import run_until_true
 
 
 class MyTask(PollerTask):
@@ -41,3 +42,25 @@ class PollerTests(SingleTaskTestCase):
 
         self.assertGreater(self.task.getValue(), 0)
         self.assertGreater(self.task.num_changes, 1)
+
+
+class MyAdaptiveTask(MyTask):
+    INTERVAL = 0.01
+    ADAPTIVE = True
+    MAX_INTERVAL = 0.08
+
+
+class AdaptivePollerTests(SingleTaskTestCase):
+    TASK = MyAdaptiveTask
+
+    def test_backoff(self):
+        current_interval = self.task.counters['current_interval']
+        run_until_true(lambda: current_interval() == 0.08, 3.0)
+
+        # Fetching a new value snaps back to the minimum interval
+        self.task.do_increment = True
+        self.task.execute(None)
+        self.task.do_increment = False
+        # (Unless it has polled again since, it's back to 0.01)
+        self.assertLessEqual(current_interval(), 0.02)
+        run_until_true(lambda: current_interval() == 0.08, 3.0)
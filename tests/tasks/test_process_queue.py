@@ -0,0 +1,68 @@
+# Copyright (c) 2014, Facebook, Inc.  All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+#
+"""Verify QueueTasks that execute work in child processes"""
+from sparts.tasks.queue import ProcessQueueTask, ProcessDied
+from sparts.tests.base import SingleTaskTestCase
+from sparts.vtask import TryLater
+
+import multiprocessing
+import os
+import time
+
+
+class MyProcessTask(ProcessQueueTask):
+    WORKERS = 2
+    CHILD_TIMEOUT = 1.0
+
+    def execute(self, item, context):
+        if item == 'crash':
+            os._exit(3)
+        if item == 'hang':
+            time.sleep(60)
+        if item == 'raise':
+            raise ValueError(item)
+        if item == 'retry' and context.attempt == 1:
+            raise TryLater()
+        return os.getpid(), item
+
+
+class TestProcessQueue(SingleTaskTestCase):
+    TASK = MyProcessTask
+
+    def test_execute_in_child(self):
+        pids = set()
+        for pid, item in self.task.map(['a', 'b', 'c', 'd']):
+            pids.add(pid)
+        self.assertNotContains(os.getpid(), pids)
+        self.assertLessEqual(len(pids), 2)
+
+        self.assertEqual(self.task.submit('retry').result(5.0)[1], 'retry')
+        with self.assertRaises(ValueError):
+            self.task.submit('raise').result(5.0)
+
+    def test_child_crash(self):
+        with self.assertRaises(ProcessDied):
+            self.task.submit('crash').result(5.0)
+
+        # Workers restart their children for subsequent work
+        results = self.task.map(['a', 'b', 'c', 'd'], timeout=5.0)
+        self.assertEqual([item for pid, item in results],
+                         ['a', 'b', 'c', 'd'])
+        self.assertGreaterEqual(self.task.n_child_restarts(), 1)
+
+    def test_child_timeout(self):
+        n_timeouts = self.task.n_child_timeouts()
+        with self.assertRaises(ProcessDied):
+            self.task.submit('hang').result(5.0)
+        self.assertEqual(self.task.n_child_timeouts() - n_timeouts, 1)
+        self.assertEqual(self.task.submit('a').result(5.0)[1], 'a')
+
+    def test_children_forked_by_zygote(self):
+        pid, item = self.task.submit('a').result(5.0)
+        self.assertNotEqual(pid, self.task._zygote.pid)
+        self.assertNotContains(pid, [c.pid for c in
+                                     multiprocessing.active_children()])
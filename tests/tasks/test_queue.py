@@ -4,10 +4,18 @@
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
 #
+from six.moves.queue import Full
+from sparts.collections import DurableQueue
+from sparts.fileutils import NamedTemporaryDirectory
 from sparts.tests.base import SingleTaskTestCase
-from sparts.tasks.queue import QueueTask
+from sparts.tasks.queue import QueueTask, DurableQueueTask, \
+    PriorityQueueTask, Dropped, DeadlineExceeded, Stopped
+from sparts.timer import Timer, run_until_true
 from sparts.vtask import TryLater
 
+import threading
+import time
+
 
 class MyTask(QueueTask):
     counter = 0
@@ -26,6 +34,12 @@ class TestMyTask(SingleTaskTestCase):
         self.task.queue.join()
         self.assertEqual(self.task.counter, 3)
 
+    def test_put_many(self):
+        self.task.put_many(['foo', 'bar'])
+        self.task.submit_nowait('baz')
+        self.task.queue.join()
+        self.assertEqual(self.task.counter, 3)
+
 
 class MyRetryTask(QueueTask):
     completed = 0
@@ -51,6 +65,145 @@ class TestRetries(SingleTaskTestCase):
         self.assertEqual(self.task.completed, 3)
 
 
+class TestShardedQueue(SingleTaskTestCase):
+    class TASK(QueueTask):
+        WORKERS = 4
+        SHARDED = True
+
+        def initTask(self):
+            super(TestShardedQueue.TASK, self).initTask()
+            self.lock = threading.Lock()
+            self.executed = []
+
+        def execute(self, item, context):
+            with self.lock:
+                self.executed.append(item)
+            return item * 2
+
+    def test_sharded(self):
+        self.assertEqual(self.task.queue.__class__.__name__,
+                         'WorkStealingQueue')
+        self.task.put_many(range(100))
+        self.assertEqual(self.task.submit(100).result(5.0), 200)
+        self.task.queue.join()
+        self.assertEqual(sorted(self.task.executed), list(range(101)))
+
+
+class TestOrderedShardedQueue(SingleTaskTestCase):
+    class TASK(QueueTask):
+        WORKERS = 3
+        SHARDED = True
+        ORDER_BY_KEY = True
+
+        def initTask(self):
+            super(TestOrderedShardedQueue.TASK, self).initTask()
+            self.by_key = {}
+
+        def shard_key(self, item):
+            return item[0]
+
+        def execute(self, item, context):
+            key, i = item
+            self.by_key.setdefault(key, []).append(
+                (threading.current_thread().name, i))
+
+    def test_ordered_by_key(self):
+        for i in range(20):
+            for key in range(5):
+                self.task.submit_nowait((key, i))
+        self.task.queue.join()
+        for key, executed in self.task.by_key.items():
+            self.assertEqual([i for name, i in executed], list(range(20)))
+            self.assertEqual(len(set(name for name, i in executed)), 1)
+
+
+class MyDurableTask(DurableQueueTask):
+    def initTask(self):
+        super(MyDurableTask, self).initTask()
+        self.executed = []
+
+    def execute(self, item, context):
+        if item == 'retry' and context.attempt == 1:
+            raise TryLater()
+        self.executed.append((item, context.attempt))
+
+
+class TestDurableQueue(SingleTaskTestCase):
+    TASK = MyDurableTask
+
+    def setUp(self):
+        # Work left over from a previous run of the task
+        self.path = NamedTemporaryDirectory()
+        queue = DurableQueue(self.path.name)
+        queue.put_many(['foo', 'retry'])
+        queue.close()
+        super(TestDurableQueue, self).setUp()
+
+    def getCreateArgs(self):
+        return ['--MyDurableTask-queue-path', self.path.name]
+
+    def tearDown(self):
+        super(TestDurableQueue, self).tearDown()
+        self.path.close()
+
+    def test_replay(self):
+        self.assertEqual(self.task.submit('bar').result(5.0), None)
+        self.task.queue.join()
+        self.assertEqual(sorted(self.task.executed),
+                         [('bar', 1), ('foo', 1), ('retry', 2)])
+
+        # Everything was acknowledged
+        queue = DurableQueue(self.path.name)
+        self.assertEqual(queue.qsize(), 0)
+        queue.close()
+
+
+class MyDurableAutoscalingTask(DurableQueueTask):
+    MAX_WORKERS = 2
+    SCALE_UP_DEPTH = 100
+    SCALE_UP_DELAY = 0.05
+    SCALE_UP_WAIT_MS = 50
+
+    def initTask(self):
+        super(MyDurableAutoscalingTask, self).initTask()
+        self.release = threading.Event()
+
+    def execute(self, item, context):
+        self.release.wait(5.0)
+
+
+class TestDurableQueueWait(SingleTaskTestCase):
+    TASK = MyDurableAutoscalingTask
+
+    def setUp(self):
+        # Replayed items are timestamped by when they were put
+        self.path = NamedTemporaryDirectory()
+        queue = DurableQueue(self.path.name)
+        queue.put_many(['a', 'b', 'c'])
+        queue.close()
+        super(TestDurableQueueWait, self).setUp()
+
+    def getCreateArgs(self):
+        return ['--MyDurableAutoscalingTask-queue-path', self.path.name]
+
+    def tearDown(self):
+        self.task.release.set()
+        super(TestDurableQueueWait, self).tearDown()
+        self.path.close()
+
+    def test_scale_up_on_wait(self):
+        oldest_age = self.task.getCounter('oldest_item_age_ms')
+        n_workers = self.task.getCounter('n_workers')
+        run_until_true(lambda: oldest_age() > 50, 2.0)
+        run_until_true(lambda: n_workers() == 2, 2.0)
+
+        # Items submitted by this process are timestamped by their context
+        self.task.submit_nowait('d')
+        self.task.release.set()
+        self.task.queue.join()
+        self.assertEqual(oldest_age(), 0.0)
+
+
 class TestMultipleWorkers(SingleTaskTestCase):
     class TASK(QueueTask):
         WORKERS = 2
@@ -58,3 +211,280 @@ class TestMultipleWorkers(SingleTaskTestCase):
 
     def test_multiple_workers(self):
         self.assertEqual(len(self.task.threads), 2)
+
+
+class MyBatchTask(QueueTask):
+    BATCH_SIZE = 4
+    BATCH_LINGER_MS = 50
+
+    def initTask(self):
+        super(MyBatchTask, self).initTask()
+        self.batches = []
+
+    def execute_batch(self, items, contexts):
+        self.batches.append(list(items))
+        results = []
+        for item, context in zip(items, contexts):
+            if item == 'fail':
+                results.append(ValueError(item))
+            elif item == 'retry' and context.attempt == 1:
+                results.append(TryLater())
+            else:
+                results.append(item + '!')
+        return results
+
+
+class TestBatches(SingleTaskTestCase):
+    TASK = MyBatchTask
+
+    def test_batch_results(self):
+        items = ['a', 'b', 'fail', 'retry', 'c', 'd']
+        futures = [self.task.submit(item) for item in items]
+
+        self.assertEqual(futures[0].result(5.0), 'a!')
+        self.assertEqual(futures[3].result(5.0), 'retry!')
+        self.assertEqual(futures[5].result(5.0), 'd!')
+        with self.assertRaises(ValueError):
+            futures[2].result(5.0)
+
+        # Items were batched (lingering for more), but never more than
+        # BATCH_SIZE at a time
+        self.assertEqual(self.task.batches[0], items[:4])
+        self.assertLessEqual(max(len(b) for b in self.task.batches), 4)
+        self.assertEqual(self.task.n_trylater(), 1)
+        self.assertEqual(self.task.n_unhandled(), 1)
+        self.assertEqual(self.task.n_completed(), 5)
+
+
+class MyDelayedRetryTask(QueueTask):
+    RETRY_BACKOFF = 0.05
+    MAX_ATTEMPTS = 3
+
+    def execute(self, item, context):
+        if item == 'after' and context.attempt == 1:
+            raise TryLater(after=0.2)
+        elif item == 'forever':
+            raise TryLater()
+        elif item == 'later':
+            raise TryLater(after=60)
+        return context.attempt
+
+
+class TestDelayedRetries(SingleTaskTestCase):
+    TASK = MyDelayedRetryTask
+
+    def test_trylater_after(self):
+        with Timer() as t:
+            future = self.task.submit('after')
+            run_until_true(
+                lambda: self.task.getCounter('retries_pending')() == 1, 1.0)
+            self.assertEqual(future.result(5.0), 2)
+        self.assertGreaterEqual(t.elapsed, 0.2)
+        self.assertEqual(self.task.getCounter('retries_pending')(), 0)
+
+    def test_backoff_max_attempts(self):
+        # Counters are shared by all instances of the task class
+        n_trylater = self.task.n_trylater()
+        n_exhausted = self.task.n_retries_exhausted()
+        with Timer() as t:
+            future = self.task.submit('forever')
+            with self.assertRaises(TryLater):
+                future.result(5.0)
+
+        # Backed off 0.05s, then 0.1s before giving up on the third attempt
+        self.assertGreaterEqual(t.elapsed, 0.15)
+        self.assertEqual(self.task.n_trylater() - n_trylater, 2)
+        self.assertEqual(self.task.n_retries_exhausted() - n_exhausted, 1)
+
+    def test_stop_while_pending(self):
+        future = self.task.submit('later')
+        run_until_true(
+            lambda: self.task.getCounter('retries_pending')() == 1, 1.0)
+        self.service.stop()
+        with self.assertRaises(Stopped):
+            future.result(5.0)
+
+
+class MyBlockingTask(QueueTask):
+    def initTask(self):
+        super(MyBlockingTask, self).initTask()
+        self.release = threading.Event()
+
+    def execute(self, item, context):
+        self.release.wait(5.0)
+
+
+class MyPriorityTask(PriorityQueueTask):
+    def initTask(self):
+        super(MyPriorityTask, self).initTask()
+        self.release = threading.Event()
+        self.executed = []
+
+    def priority(self, item):
+        return item[0]
+
+    def execute(self, item, context):
+        self.release.wait(5.0)
+        self.executed.append(item[1])
+
+
+class TestPriorityQueueTask(SingleTaskTestCase):
+    TASK = MyPriorityTask
+
+    def submitBehindBusy(self, items):
+        self.task.submit((0, 'busy'))
+        run_until_true(lambda: self.task.queue.empty(), 1.0)
+        return [self.task.submit(item) for item in items]
+
+    def test_priorities(self):
+        futures = self.submitBehindBusy([(2, 'a'), (1, 'b'), (2, 'c'),
+                                         (3, 'd')])
+        self.task.update_priority((3, 'd'), 0)
+        self.task.remove((1, 'b'))
+        self.assertTrue(futures[1].cancelled())
+        with self.assertRaises(ValueError):
+            self.task.remove((1, 'b'))
+
+        self.task.release.set()
+        self.task.queue.join()
+        self.assertEqual(self.task.executed, ['busy', 'd', 'a', 'c'])
+
+    def test_oldest_item_age(self):
+        oldest_age = self.task.getCounter('oldest_item_age_ms')
+        self.submitBehindBusy([(2, 'a'), (1, 'b')])
+        run_until_true(lambda: oldest_age() > 0, 1.0)
+        self.task.release.set()
+        self.task.queue.join()
+        self.assertEqual(oldest_age(), 0.0)
+
+    def test_stop_while_queued(self):
+        self.submitBehindBusy([(1, 'a'), (2, 'b')])
+        self.task.stop()
+        self.task.release.set()
+        for thread in self.task.threads:
+            thread.join(5.0)
+            self.assertFalse(thread.is_alive())
+
+
+class MyAutoscalingTask(MyBlockingTask):
+    MAX_WORKERS = 3
+    SCALE_UP_DELAY = 0.05
+    SCALE_DOWN_IDLE = 0.2
+
+
+class TestAutoscaling(SingleTaskTestCase):
+    TASK = MyAutoscalingTask
+
+    def test_scale_up_and_down(self):
+        n_workers = self.task.getCounter('n_workers')
+        self.assertEqual(n_workers(), 1)
+
+        # Keep the queue backed up until we've grown to MAX_WORKERS (plus
+        # the autoscaler thread)
+        for i in range(10):
+            self.task.submit_nowait(i)
+        run_until_true(lambda: n_workers() == 3, 2.0)
+        self.assertEqual(
+            len([t for t in self.task.threads if t.is_alive()]), 4)
+
+        # Once idle, workers exit back down to MIN_WORKERS
+        self.task.release.set()
+        self.task.queue.join()
+        run_until_true(lambda: n_workers() == 1, 5.0)
+
+    def test_stop_while_scaling(self):
+        self.task.submit_nowait(0)
+        run_until_true(lambda: self.task.queue.empty(), 1.0)
+        self.service.stop()
+        self.assertFalse(self.task._addWorker())
+        self.task.stop()
+        self.task.release.set()
+        self.task.join()
+        self.assertFalse(self.task.running)
+
+
+class TestQueueWait(SingleTaskTestCase):
+    TASK = MyBlockingTask
+
+    def test_queue_wait(self):
+        oldest_age = self.task.getCounter('oldest_item_age_ms')
+        self.assertEqual(oldest_age(), 0.0)
+
+        # The worker is blocked on the first item, so the others wait
+        self.task.submit_nowait('busy')
+        self.task.put_many(['a', 'b'])
+        time.sleep(0.1)
+        self.assertGreaterEqual(oldest_age(), 100.0)
+
+        self.task.release.set()
+        self.task.queue.join()
+        self.assertEqual(oldest_age(), 0.0)
+        self.assertGreaterEqual(
+            self.task.queue_wait_ms.getCounter('queue_wait_ms.max.60'), 100.0)
+
+
+class TestOverflow(SingleTaskTestCase):
+    class TASK(MyBlockingTask):
+        MAX_ITEMS = 2
+        OVERFLOW_POLICY = 'reject'
+
+    def fill(self):
+        # The worker blocks on the first item, and two more fill the queue
+        futures = [self.task.submit('busy')]
+        run_until_true(lambda: self.task.queue.empty(), 1.0)
+        futures.extend([self.task.submit('a'), self.task.submit('b')])
+        return futures
+
+    def test_reject(self):
+        n_rejected = self.task.n_rejected()
+        futures = self.fill()
+        with self.assertRaises(Full):
+            self.task.submit('c').result(1.0)
+        self.assertEqual(self.task.n_rejected() - n_rejected, 1)
+        self.task.release.set()
+        self.assertEqual(futures[2].result(5.0), None)
+
+    def test_block_timeout(self):
+        self.task.setTaskOption('overflow_policy', 'block')
+        self.task.setTaskOption('overflow_timeout', 0.05)
+        n_timed_out = self.task.n_timed_out()
+        futures = self.fill()
+        with Timer() as t:
+            future = self.task.submit('c')
+        self.assertGreaterEqual(t.elapsed, 0.05)
+        with self.assertRaises(Full):
+            future.result(1.0)
+        self.assertEqual(self.task.n_timed_out() - n_timed_out, 1)
+        self.task.release.set()
+        self.assertEqual(futures[2].result(5.0), None)
+
+    def test_drop_oldest(self):
+        self.task.setTaskOption('overflow_policy', 'drop_oldest')
+        n_dropped = self.task.n_dropped()
+        futures = self.fill()
+        future = self.task.submit('c')
+        with self.assertRaises(Dropped):
+            futures[1].result(1.0)
+        self.assertEqual(self.task.n_dropped() - n_dropped, 1)
+        self.task.release.set()
+        self.assertEqual(future.result(5.0), None)
+
+    def test_deadline(self):
+        n_expired = self.task.n_expired()
+        self.task.submit('busy')
+        run_until_true(lambda: self.task.queue.empty(), 1.0)
+        expired = self.task.submit('a', deadline=time.time())
+        future = self.task.submit('b', deadline=time.time() + 5.0)
+        self.task.release.set()
+        self.assertEqual(future.result(5.0), None)
+        with self.assertRaises(DeadlineExceeded):
+            expired.result(5.0)
+        self.assertEqual(self.task.n_expired() - n_expired, 1)
+
+    def test_stop_while_full(self):
+        self.task.setTaskOption('overflow_policy', 'block')
+        self.fill()
+        with Timer() as t:
+            self.task.stop()
+        self.assertLess(t.elapsed, 1.0)
+        self.task.release.set()
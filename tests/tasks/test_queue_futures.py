@@ -14,6 +14,8 @@ try:
 except ImportError:
     raise Skip("futures must be installed to run this test")
 
+import itertools
+
 
 class BarTask(QueueTask):
     """Helper task.  Returns results for callbacks.
@@ -76,6 +78,28 @@ class FutureTests(SingleTaskTestCase):
         with self.assertRaises(futures.TimeoutError):
             self.map(inputs, timeout=0.05)
 
+    def test_imap(self):
+        """Test out the streaming, windowed imap APIs"""
+        # Unbounded inputs are fine, as long as results are consumed
+        inputs = (str(i) for i in itertools.count())
+        results = list(itertools.islice(self.task.imap(inputs, window=3), 5))
+        self.assertEqual(results, ['0bar', '1bar', '2bar', '3bar', '4bar'])
+
+        inputs = (str(i) for i in itertools.count())
+        results = self.task.imap_unordered(inputs, window=3)
+        self.assertEqual(len(list(itertools.islice(results, 5))), 5)
+
+        results = self.task.imap_unordered(map(str, range(20)), window=4)
+        self.assertEqual(sorted(results),
+                         sorted(str(i) + 'bar' for i in range(20)))
+
+    def test_imap_timeout(self):
+        self.task.do_trylater = True
+        with self.assertRaises(futures.TimeoutError):
+            list(self.task.imap(map(str, range(5)), timeout=0.05))
+        with self.assertRaises(futures.TimeoutError):
+            list(self.task.imap_unordered(map(str, range(5)), timeout=0.05))
+
     def test_future_raise(self):
         """Make sure raising exceptions works properly.
         
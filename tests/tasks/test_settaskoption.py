@@ -36,3 +36,18 @@ class SetOptionTaskTests(SingleTaskTestCase):
             ['1', '2', '3'],
             self.task.getTaskOption('other_list_option')
         )
+
+    def test_option_cache(self):
+        self.assertEqual(0, self.task.some_option)
+
+        # Cached reads shouldn't need to look up the option again
+        self.task.getTaskOption = self.mock.Mock()
+        self.assertEqual(0, self.task.some_option)
+        self.assertFalse(self.task.getTaskOption.called)
+        del self.task.getTaskOption
+
+        # Setting options through either API refreshes the cached values
+        self.task.setTaskOption('some_option', 3)
+        self.assertEqual(3, self.task.some_option)
+        self.service.setOption('SetOptionTask_some_option', '4')
+        self.assertEqual(4, self.task.some_option)
@@ -4,9 +4,16 @@
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
 #
-from sparts.collections import PriorityQueue, UniqueQueue, Duplicate
+from six.moves.queue import Empty, Full
+from sparts.collections import PriorityQueue, Queue, UniqueQueue, Duplicate, \
+    WorkStealingQueue, DurableQueue
+from sparts.fileutils import NamedTemporaryDirectory
 from sparts.tests.base import BaseSpartsTestCase
 
+import os
+import threading
+import time
+
 
 class PriorityQueueTests(BaseSpartsTestCase):
     def test_basic_functionality(self):
@@ -41,6 +48,47 @@ class PriorityQueueTests(BaseSpartsTestCase):
         self.assertTrue(queue.empty())
 
 
+    def test_fifo_ties(self):
+        queue = PriorityQueue(key=lambda item: item['priority'])
+        for i in range(10):
+            queue.put({'priority': i % 2, 'i': i})
+        self.assertEqual([queue.get()['i'] for i in range(10)],
+                         [0, 2, 4, 6, 8, 1, 3, 5, 7, 9])
+
+    def test_update_priority(self):
+        queue = PriorityQueue()
+        queue.put_many(['c', 'a', 'b', 'd'])
+        queue.update_priority('d', '')
+        self.assertEqual(queue.remove('b'), 'b')
+        with self.assertRaises(ValueError):
+            queue.remove('b')
+        with self.assertRaises(ValueError):
+            queue.update_priority('e', '')
+        self.assertEqual(queue.unfinished_tasks, 3)
+        self.assertEqual([queue.get(), queue.get(), queue.get()],
+                         ['d', 'a', 'c'])
+
+        # Unhashable items can be queued, just not looked up
+        queue.put([1])
+        self.assertEqual(queue.get(), [1])
+
+    def test_aging(self):
+        queue = PriorityQueue(aging=10.0)
+        queue.put(1)
+        time.sleep(0.2)
+        # Queued for 0.2s, the first item now has a priority of -1
+        queue.put(0)
+        self.assertEqual([queue.get(), queue.get()], [1, 0])
+
+    def test_interrupt(self):
+        queue = PriorityQueue()
+        queue.put(1)
+        sentinel = object()
+        queue.interrupt(sentinel)
+        self.assertIs(queue.get(), sentinel)
+        self.assertEqual(queue.get(), 1)
+
+
 class UniqueQueueTests(BaseSpartsTestCase):
     def test_basic_functionality(self):
         # Make a priority queue
@@ -94,3 +142,259 @@ class UniqueQueueTests(BaseSpartsTestCase):
         queue.unsee(0)
         queue.put(0)
         self.assertFalse(queue.empty())
+
+
+class QueueTests(BaseSpartsTestCase):
+    def test_put_many(self):
+        queue = Queue()
+        queue.put_many([3, 1, 2])
+        self.assertEqual(queue.qsize(), 3)
+        self.assertEqual(queue.unfinished_tasks, 3)
+        self.assertEqual([queue.get(), queue.get(), queue.get()], [3, 1, 2])
+
+        # Priority queues still sort items put together
+        queue = PriorityQueue()
+        queue.put_many([3, 1, 2])
+        self.assertEqual([queue.get(), queue.get(), queue.get()], [1, 2, 3])
+
+    def test_put_many_bounded(self):
+        queue = Queue(maxsize=2)
+        with self.assertRaises(Full):
+            queue.put_many([1, 2, 3], block=False)
+        self.assertEqual(queue.qsize(), 2)
+
+        with self.assertRaises(Full):
+            queue.put_many([3], timeout=0.01)
+
+        # Blocked puts complete as a consumer makes room
+        got = []
+        consumer = threading.Thread(
+            target=lambda: got.extend(queue.get() for i in range(5)))
+        consumer.start()
+        queue.put_many([3, 4, 5])
+        consumer.join(5.0)
+        self.assertEqual(got, [1, 2, 3, 4, 5])
+
+    def test_put_evict(self):
+        queue = Queue(maxsize=2)
+        self.assertIsNone(queue.put_evict(1))
+        self.assertIsNone(queue.put_evict(2))
+        self.assertEqual(queue.put_evict(3), 1)
+        self.assertEqual(queue.put_evict(4, keep=2), 3)
+        self.assertEqual(queue.unfinished_tasks, 2)
+        self.assertEqual([queue.get(), queue.get()], [2, 4])
+        with self.assertRaises(ValueError):
+            queue.put_evict(5, 'lowest')
+        self.assertTrue(queue.empty())
+
+        queue = PriorityQueue(maxsize=3)
+        queue.put_many([5, 1, 3])
+        self.assertEqual(queue.put_evict(2, 'lowest'), 5)
+        self.assertEqual(queue.put_evict(6, 'lowest'), 6)
+        self.assertEqual(queue.put_evict(4, 'oldest'), 1)
+        self.assertEqual(queue.qsize(), 3)
+        self.assertEqual([queue.get(), queue.get(), queue.get()], [2, 3, 4])
+
+        # Evicted items may be re-queued in a UniqueQueue
+        queue = UniqueQueue(maxsize=1)
+        queue.put(1)
+        self.assertEqual(queue.put_evict(2), 1)
+        queue.put_evict(1)
+        self.assertEqual(queue.get(), 1)
+
+    def test_oldest_time(self):
+        key = lambda item: item[1]
+        queue = Queue()
+        self.assertIsNone(queue.oldest_time(key))
+        queue.put_many([('a', 1.0), ('b', 2.0)])
+        self.assertEqual(queue.oldest_time(key), 1.0)
+        queue.get()
+        self.assertEqual(queue.oldest_time(key), 2.0)
+
+        # The oldest item isn't necessarily the next one to be got
+        queue = PriorityQueue(key=lambda item: item[0])
+        queue.put_many([(2, 1.0), (1, 2.0)])
+        self.assertEqual(queue.get(), (1, 2.0))
+        self.assertEqual(queue.oldest_time(key), 1.0)
+        queue.get()
+        self.assertIsNone(queue.oldest_time(key))
+
+        # Nor on the first deque, for WorkStealingQueues
+        queue = WorkStealingQueue(2)
+        for item in [('a', 3.0), ('b', 1.0), ('c', None)]:
+            queue.put(item)
+        self.assertEqual(queue.oldest_time(key), 1.0)
+
+
+class WorkStealingQueueTests(BaseSpartsTestCase):
+    def test_steal(self):
+        queue = WorkStealingQueue(2)
+        for i in range(4):
+            queue.put(i)
+        self.assertEqual(queue.qsize(), 4)
+
+        # Items were put round-robin.  This thread owns the first deque, and
+        # steals from the second once it's empty.
+        self.assertEqual([queue.get_nowait() for i in range(4)], [0, 2, 1, 3])
+        with self.assertRaises(Empty):
+            queue.get(timeout=0.01)
+        self.assertEqual(queue.unfinished_tasks, 4)
+        for i in range(4):
+            queue.task_done()
+        queue.join()
+        with self.assertRaises(ValueError):
+            queue.task_done()
+
+    def test_ordered(self):
+        queue = WorkStealingQueue(2, key=lambda item: item[0], ordered=True)
+        got = {}
+
+        def consume():
+            mine = got.setdefault(threading.current_thread().name, [])
+            while True:
+                try:
+                    mine.append(queue.get(timeout=0.1))
+                except Empty:
+                    return
+                queue.task_done()
+
+        threads = [threading.Thread(target=consume, name=str(i))
+                   for i in range(2)]
+        for t in threads:
+            t.start()
+        for i in range(3):
+            queue.put((0, i))
+            queue.put((1, i))
+        for t in threads:
+            t.join(5.0)
+
+        # Each key's items were got in order, by one of the consumers
+        self.assertEqual(sorted(got.values()),
+                         [[(0, 0), (0, 1), (0, 2)], [(1, 0), (1, 1), (1, 2)]])
+        queue.join()
+
+    def test_interrupt(self):
+        queue = WorkStealingQueue(2)
+        got = []
+        consumer = threading.Thread(target=lambda: got.append(queue.get()))
+        consumer.start()
+        queue.interrupt('stop')
+        consumer.join(5.0)
+        self.assertEqual(got, ['stop'])
+        queue.put(1)
+        self.assertEqual(queue.get(), 'stop')
+
+
+class DurableQueueTests(BaseSpartsTestCase):
+    def setUp(self):
+        super(DurableQueueTests, self).setUp()
+        self.path = NamedTemporaryDirectory()
+
+    def tearDown(self):
+        self.path.close()
+        super(DurableQueueTests, self).tearDown()
+
+    def test_replay(self):
+        queue = DurableQueue(self.path.name)
+        queue.put_many(['a', 'b', 'c'])
+        queue.put({'d': 4})
+        a = queue.get()
+        self.assertEqual(a, 'a')
+        self.assertEqual(queue.get(), 'b')
+        self.assertTrue(queue.ack(a))
+        self.assertFalse(queue.ack(a))
+        queue.close()
+
+        # 'b' was got, but not acknowledged, so it's replayed, in order
+        queue = DurableQueue(self.path.name)
+        self.assertEqual(queue.unfinished_tasks, 3)
+        self.assertEqual([queue.get(), queue.get(), queue.get()],
+                         ['b', 'c', {'d': 4}])
+        queue.close()
+
+    def test_requeue(self):
+        queue = DurableQueue(self.path.name, fsync=False)
+        queue.put(['x'])
+        item = queue.get()
+
+        # Re-queueing an item that's in flight supersedes its record
+        queue.requeue(item)
+        self.assertEqual(queue.get(), ['x'])
+        queue.close()
+
+        queue = DurableQueue(self.path.name)
+        self.assertEqual(queue.qsize(), 1)
+        self.assertEqual(queue.get(), ['x'])
+        queue.close()
+
+    def test_put_inflight(self):
+        queue = DurableQueue(self.path.name, fsync=False)
+        queue.put(1)
+        item = queue.get()
+
+        # Putting the same object again is a separate item
+        queue.put(item)
+        queue.close()
+
+        queue = DurableQueue(self.path.name)
+        self.assertEqual(queue.qsize(), 2)
+        queue.close()
+
+    def test_segments(self):
+        queue = DurableQueue(self.path.name, segment_bytes=256)
+        for i in range(20):
+            queue.put(i)
+        self.assertGreater(len(os.listdir(self.path.name)), 1)
+        for i in range(19):
+            item = queue.get()
+            self.assertEqual(item, i)
+            self.assertTrue(queue.ack(item))
+
+        # Segments are deleted up to the one with the unacknowledged item
+        queue.sync()
+        segment = queue.queue[0][1]
+        self.assertGreater(segment.number, 0)
+        self.assertEqual(sorted(os.listdir(self.path.name))[0],
+                         '%016x.log' % segment.number)
+        queue.close()
+
+        queue = DurableQueue(self.path.name, segment_bytes=256)
+        self.assertEqual(queue.get_nowait(), 19)
+        with self.assertRaises(Empty):
+            queue.get_nowait()
+        queue.close()
+
+    def test_torn_write(self):
+        queue = DurableQueue(self.path.name)
+        queue.put_many(['a', 'b'])
+        queue.close()
+
+        # Corrupt the last record, as if a crash interrupted writing it
+        name, = os.listdir(self.path.name)
+        with open(os.path.join(self.path.name, name), 'r+b') as f:
+            data = f.read()
+            f.seek(data.rindex(b'b'))
+            f.write(b'X')
+
+        queue = DurableQueue(self.path.name)
+        self.assertEqual(queue.qsize(), 1)
+        queue.put('c')
+        self.assertEqual([queue.get(), queue.get()], ['a', 'c'])
+        queue.close()
+
+    def test_group_commit(self):
+        queue = DurableQueue(self.path.name)
+        threads = [threading.Thread(
+                       target=lambda i=i: [queue.put((i, j))
+                                           for j in range(50)])
+                   for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10.0)
+        self.assertEqual(queue.qsize(), 200)
+        queue.close()
+
+        queue = DurableQueue(self.path.name)
+        self.assertEqual(queue.qsize(), 200)
+        queue.close()
@@ -7,6 +7,7 @@
 from sparts.tests.base import BaseSpartsTestCase
 from sparts import counters
 
+import threading
 import time
 
 class CounterTests(BaseSpartsTestCase):
@@ -141,3 +142,228 @@ class CounterTests(BaseSpartsTestCase):
         self.assertEqual(c.getCounter('count.1000'), 0, str((now, c.samples)))
         self.assertEqual(c.getCounter('sum.100'), 0.0)
         self.assertEqual(c.getCounter('sum.1000'), 0.0)
+
+    def testPercentile(self):
+        """Test `counters.Percentile()`"""
+        c = counters.Percentile(0.5)
+        self.assertEqual(c.suffix, 'p50')
+        self.assertIs(c(), None)
+        for i in range(1, 1001):
+            c.add(i)
+        self.assertAlmostEqual(c(), 500, delta=5)
+
+        self.assertEqual(counters.Percentile(0.999).suffix, 'p999')
+
+    def testQuantileSketch(self):
+        """Test `counters.QuantileSketch()` accuracy, merging and bounds"""
+        s = counters.QuantileSketch(relative_accuracy=0.01)
+        for i in range(-100, 1001):
+            s.add(i)
+        self.assertEqual(s.count, 1101)
+        self.assertAlmostEqual(s.quantile(0.0), -100, delta=1)
+        self.assertAlmostEqual(s.quantile(0.5), 450, delta=4.5)
+        self.assertAlmostEqual(s.quantile(0.99), 989, delta=9.9)
+        self.assertAlmostEqual(s.quantile(1.0), 1000, delta=10)
+
+        # Merged sketches should behave like one big sketch
+        other = counters.QuantileSketch(relative_accuracy=0.01)
+        for i in range(1001, 2001):
+            other.add(i)
+        s.merge(other)
+        self.assertEqual(s.count, 2101)
+        self.assertAlmostEqual(s.quantile(1.0), 2000, delta=20)
+
+        # Bucket count should stay bounded, favoring the high quantiles
+        s = counters.QuantileSketch(max_buckets=10)
+        for i in range(1, 100001):
+            s.add(i)
+        self.assertLessEqual(len(s._positive), 10)
+        self.assertAlmostEqual(s.quantile(1.0), 100000, delta=1000)
+
+    def testQuantileSketchNegative(self):
+        """Test `counters.QuantileSketch()` with only negative values"""
+        s = counters.QuantileSketch(relative_accuracy=0.01)
+        for i in range(-100, 0):
+            s.add(i)
+        self.assertAlmostEqual(s.quantile(0.0), -100, delta=1)
+        self.assertAlmostEqual(s.quantile(1.0), -1, delta=0.01)
+
+        # As if another thread was part way through adding a value
+        s.count += 1
+        self.assertAlmostEqual(s.quantile(1.0), -1, delta=0.01)
+        s.add(0)
+        s.count += 1
+        self.assertEqual(s.quantile(1.0), 0.0)
+
+    def testSamplePercentiles(self):
+        c = counters.samples(
+            types=[counters.SampleType.P50, counters.SampleType.P99],
+            windows=[100])
+        for i in range(1, 101):
+            c.add(i)
+        self.assertAlmostEqual(c.getCounter('p50.100'), 50, delta=1)
+        self.assertAlmostEqual(c.getCounter('p99.100'), 99, delta=1)
+
+    def testBucketedSamples(self):
+        c = counters.samples(
+            types=[counters.SampleType.COUNT, counters.SampleType.SUM,
+                   counters.SampleType.MAX, counters.SampleType.P50],
+            windows=[100, 1000], granularity=1)
+
+        now = time.time()
+        c._now = self.mock.Mock()
+
+        # Many samples in a single slice only cost a single bucket
+        c._now.return_value = now
+        for i in range(1000):
+            c.add(10.0)
+        self.assertEqual(len([b for b in c.buckets if b is not None]), 1)
+        self.assertEqual(len(c.samples), 0)
+
+        self.assertEqual(c.getCounter('count.100'), 1000)
+        self.assertEqual(c.getCounter('sum.1000'), 10000.0)
+        self.assertEqual(c.getCounter('max.100'), 10.0)
+        self.assertAlmostEqual(c.getCounter('p50.100'), 10.0, delta=0.1)
+
+        # At t=10, add one value of 20.0
+        c._now.return_value = now + 10
+        c.add(20.0)
+        self.assertEqual(c.getCounter('count.100'), 1001)
+        self.assertEqual(c.getCounter('max.1000'), 20.0)
+
+        # At t=101, the first slice should have fallen out of the 100 window
+        c._now.return_value = now + 101
+        self.assertEqual(c.getCounter('count.100'), 1)
+        self.assertEqual(c.getCounter('count.1000'), 1001)
+        self.assertEqual(c.getCounter('sum.100'), 20.0)
+
+        # At t=1001, only the t=10 slice should remain in the 1000 window
+        c._now.return_value = now + 1001
+        self.assertEqual(c.getCounter('count.100'), 0)
+        self.assertEqual(c.getCounter('count.1000'), 1)
+        self.assertIs(c.getCounter('max.100'), None)
+
+        # At t=1011, all values should be gone from all windows.
+        c._now.return_value = now + 1011
+        self.assertEqual(c.getCounter('count.1000'), 0)
+        self.assertEqual(c.getCounter('sum.1000'), 0.0)
+
+        # Re-using a slot of the ring discards its stale contents
+        c._now.return_value = now + 2002
+        c.add(5.0)
+        self.assertEqual(c.getCounter('count.1000'), 1)
+        self.assertEqual(c.getCounter('sum.1000'), 5.0)
+
+    def _addFromThreads(self, c, value, nthreads=8, count=1000):
+        """Helper that calls `c.add(value)` `count` times from many threads"""
+        def worker():
+            for i in range(count):
+                c.add(value)
+        threads = [threading.Thread(target=worker) for i in range(nthreads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def testShardedSum(self):
+        """Test `counters.Sum(sharded=True)`"""
+        c = counters.counter(sharded=True)
+        self.assertEqual(c(), 0.0)
+        self._addFromThreads(c, 1.0)
+        c.increment()
+        self.assertEqual(c(), 8001.0)
+        nshards = len(list(c._shards))
+        self.assertLessEqual(nshards, 9)
+
+        # Shards of exited threads, and their totals, are reused.  A thread
+        # may be joined just before its shard is released, though.
+        for i in range(5):
+            self._addFromThreads(c, 1.0, nthreads=1)
+        self.assertEqual(c(), 13001.0)
+        self.assertLessEqual(len(list(c._shards)), nshards + 1)
+
+        c.reset(0.5)
+        self.assertEqual(c(), 0.5)
+
+    def testShardedSamples(self):
+        for granularity in [None, 1]:
+            c = counters.samples(
+                types=[counters.SampleType.COUNT, counters.SampleType.SUM,
+                       counters.SampleType.MAX],
+                windows=[100], granularity=granularity, sharded=True)
+            self._addFromThreads(c, 2.0)
+            c.add(3.0)
+            self.assertEqual(c.getCounter('count.100'), 8001)
+            self.assertEqual(c.getCounter('sum.100'), 16003.0)
+            self.assertEqual(c.getCounter('max.100'), 3.0)
+
+    def testHistogram(self):
+        """Test `counters.histogram()` bucket counts and exported names"""
+        for granularity in [None, 1]:
+            c = counters.histogram(bounds=[1, 10, 100], windows=[60],
+                                   name='latency', granularity=granularity)
+            for value in [0.5, 1, 5, 50, 500]:
+                c.add(value)
+
+            self.assertEqual(c.getCounter('latency.bucket.1.60'), 2)
+            self.assertEqual(c.getCounter('latency.bucket.10.60'), 3)
+            self.assertEqual(c.getCounter('latency.bucket.100.60'), 4)
+            self.assertEqual(c.getCounter('latency.bucket.inf.60'), 5)
+            self.assertEqual(c.getCounter('latency.count.60'), 5)
+            self.assertEqual(c.getCounter('latency.sum.60'), 556.5)
+            self.assertEqual(sorted(c.iterkeys()), sorted(c.getCounters()))
+
+        self.assertEqual(counters.exponential_bounds(1, 2, 4), [1, 2, 4, 8])
+
+    def testSampleRate(self):
+        for granularity in [None, 1]:
+            c = counters.samples(
+                types=[counters.SampleType.COUNT, counters.SampleType.RATE],
+                windows=[10, 100], granularity=granularity)
+            c._now = lambda: 1000.0
+            for i in range(50):
+                c.add(2.0)
+            self.assertEqual(c.getCounter('count.10'), 50)
+            self.assertEqual(c.getCounter('rate.10'), 10.0)
+            self.assertEqual(c.getCounter('rate.100'), 1.0)
+
+    def testBucketedRateSpan(self):
+        """Rates are per second of the slices a window was rounded out to"""
+        c = counters.samples(types=[counters.SampleType.RATE], windows=[10],
+                             granularity=1)
+        c._now = lambda: 1000.5
+        for i in range(21):
+            c.add(1.0)
+
+        # The window covers [990.0, 1000.5), not just the last 10 seconds
+        self.assertEqual(c.getCounter('rate.10'), 2.0)
+
+    def testSumRate(self):
+        """Test `counters.Sum(windows=...)` rate exports"""
+        c = counters.counter(name='requests', windows=[10, 60])
+        c._series._now = lambda: 1000.0
+        for i in range(30):
+            c.increment()
+        self.assertEqual(c(), 30.0)
+
+        callbacks = dict(c._genCounterCallbacks())
+        self.assertEqual(sorted(callbacks),
+                         ['requests', 'requests.rate.10', 'requests.rate.60'])
+        self.assertEqual(callbacks['requests'](), 30.0)
+        self.assertEqual(callbacks['requests.rate.10'](), 3.0)
+        self.assertEqual(callbacks['requests.rate.60'](), 0.5)
+
+        # Resetting the total resets its rates too
+        c.reset()
+        self.assertEqual(callbacks['requests'](), 0.0)
+        self.assertEqual(callbacks['requests.rate.10'](), 0.0)
+        c.incrementBy(20)
+        self.assertEqual(callbacks['requests.rate.10'](), 2.0)
+
+    def testShardedSumRateReset(self):
+        c = counters.counter(name='requests', windows=[10], sharded=True)
+        c._series._now = lambda: 1000.0
+        c.incrementBy(10)
+        self.assertEqual(c._series.getCounter('requests.rate.10'), 1.0)
+        c.reset()
+        self.assertEqual(c._series.getCounter('requests.rate.10'), 0.0)
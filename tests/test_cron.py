@@ -0,0 +1,53 @@
+# Copyright (c) 2014, Facebook, Inc.  All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+#
+from datetime import datetime
+from sparts.cron import CronSchedule
+from sparts.tests.base import BaseSpartsTestCase
+
+import time
+
+
+def ts(*args):
+    return time.mktime(datetime(*args).timetuple())
+
+
+class CronScheduleTests(BaseSpartsTestCase):
+    def assertNext(self, expression, after, expected):
+        self.assertEqual(
+            datetime.fromtimestamp(CronSchedule(expression).next(ts(*after))),
+            datetime(*expected))
+
+    def test_every_minute(self):
+        self.assertNext('* * * * *', (2014, 5, 6, 7, 8, 9),
+                        (2014, 5, 6, 7, 9))
+        self.assertNext('* * * * *', (2014, 5, 6, 7, 8),
+                        (2014, 5, 6, 7, 9))
+
+    def test_steps_and_ranges(self):
+        self.assertNext('*/15 * * * *', (2014, 5, 6, 7, 8),
+                        (2014, 5, 6, 7, 15))
+        self.assertNext('0,30 9-17/4 * * *', (2014, 5, 6, 17, 31),
+                        (2014, 5, 7, 9, 0))
+        self.assertNext('5/20 * * * *', (2014, 5, 6, 7, 46),
+                        (2014, 5, 6, 8, 5))
+
+    def test_days(self):
+        # 2014-05-06 was a tuesday
+        self.assertNext('0 0 * * sun', (2014, 5, 6), (2014, 5, 11))
+        self.assertNext('0 0 * * 7', (2014, 5, 6), (2014, 5, 11))
+        self.assertNext('@monthly', (2014, 12, 6), (2015, 1, 1))
+        self.assertNext('0 0 29 feb *', (2014, 3, 1), (2016, 2, 29))
+        # Either the day of the month or of the week
+        self.assertNext('0 0 13 * fri', (2014, 5, 6), (2014, 5, 9))
+
+    def test_invalid(self):
+        for expression in ['* * * *', '60 * * * *', '* * * foo *',
+                           '5-1 * * * *']:
+            with self.assertRaises(ValueError):
+                CronSchedule(expression)
+        with self.assertRaises(ValueError):
+            CronSchedule('0 0 30 2 *').next(time.time())
@@ -12,6 +12,7 @@ try:
 except ImportError:
     raise Skip("thrift is required to run this test")
 
+from sparts.counters import CallbackCounter
 from sparts.tasks.fb303 import FB303HandlerTask
 from sparts.tasks.tornado import TornadoHTTPTask
 from sparts.tasks.tornado_thrift import TornadoThriftHandler
@@ -70,3 +71,26 @@ class TestFB303(MultiTaskTestCase):
                     host=host, port=bound_addr[1],
                     path='/thrift', module=FacebookService)
             self.assertEqual(client.getStatus(), fb_status.ALIVE)
+
+    def testCounterQueries(self):
+        handler = self.service.requireTask(FB303HandlerTask)
+        handler.counters['n_foo'] = CallbackCounter(lambda: 3)
+        handler.counters['n_bar'] = CallbackCounter(lambda: None)
+
+        self.assertEqual(
+            handler.getSelectedCounters(['FB303HandlerTask.n_foo',
+                                         'FB303HandlerTask.n_bar', 'x']),
+            {'FB303HandlerTask.n_foo': 3})
+        self.assertEqual(handler.getRegexCounters(r'.*\.n_f.*'),
+                         {'FB303HandlerTask.n_foo': 3})
+        self.assertEqual(handler.getRegexCounters(r'.*\.n_f'), {})
+
+        # The queries are also exposed over thrift
+        server = self.service.requireTask(NBServerTask)
+        client = ThriftClient.for_localhost(
+                server.bound_port, module=FacebookService)
+        self.assertEqual(
+            client.getSelectedCounters(['FB303HandlerTask.n_foo']),
+            {'FB303HandlerTask.n_foo': 3})
+        self.assertEqual(client.getRegexCounters(r'FB303HandlerTask\..*'),
+                         {'FB303HandlerTask.n_foo': 3})
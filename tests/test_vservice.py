@@ -4,9 +4,11 @@
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
 #
+from sparts.counters import counter, CallbackCounter
 from sparts.sparts import option
-from sparts.tests.base import ServiceTestCase
+from sparts.tests.base import MultiTaskTestCase, ServiceTestCase
 from sparts.vservice import VService
+from sparts.vtask import SkipTask, VTask
 
 class VServiceTests(ServiceTestCase):
     def test_verifyCustomName(self):
@@ -112,3 +114,67 @@ class VServiceOptionOverrideTests(ServiceTestCase):
         self.assertEqual(self.service.basicopt, "foo")
         self.assertEqual(self.service.opt_uscore, "bar")
         self.assertEqual(self.service.opt_uscore2, "baz")
+
+
+class CounterTask(VTask):
+    LOOPLESS = True
+    n_foo = counter()
+    n_bar = counter()
+
+    def initTask(self):
+        super(CounterTask, self).initTask()
+        self.counters['dynamic'] = CallbackCounter(lambda: 42)
+
+
+class SkippedCounterTask(VTask):
+    LOOPLESS = True
+    n_foo = counter()
+
+    def initTask(self):
+        raise SkipTask("Skipped")
+
+
+class VServiceCounterTests(MultiTaskTestCase):
+    TASKS = [CounterTask, SkippedCounterTask]
+
+    def setUp(self):
+        # Bypass MultiTaskTestCase's check that all TASKS are still present,
+        # since SkippedCounterTask is expected to be removed.
+        ServiceTestCase.setUp(self)
+
+    def test_counter_registry(self):
+        service = self.service
+        counters = service.getCounters()
+        self.assertContains('CounterTask.n_foo', counters)
+        self.assertContains('CounterTask.dynamic', counters)
+        self.assertNotContains('SkippedCounterTask.n_foo', counters)
+
+        self.assertEqual(service.getCounter('CounterTask.dynamic')(), 42)
+        service.requireTask('CounterTask').n_foo.increment()
+        self.assertEqual(service.getCounter('CounterTask.n_foo')(), 1.0)
+
+        self.assertEqual(
+            sorted(service.getCountersWithPrefix('CounterTask.n_')),
+            ['CounterTask.n_bar', 'CounterTask.n_foo'])
+        self.assertEqual(sorted(service.getRegexCounters('.*n_ba.')),
+                         ['CounterTask.n_bar'])
+        # Like fb303, the whole name must match
+        self.assertEqual(service.getRegexCounters('.*n_ba'), {})
+        self.assertEqual(
+            sorted(service.getSelectedCounters(['CounterTask.n_bar', 'x'])),
+            ['CounterTask.n_bar'])
+
+        # Counters added and removed later are reflected in queries
+        task = service.requireTask('CounterTask')
+        task.counters['n_baz'] = CallbackCounter(lambda: 1)
+        self.assertEqual(sorted(service.getRegexCounters('.*n_ba.')),
+                         ['CounterTask.n_bar', 'CounterTask.n_baz'])
+        del task.counters['n_baz']
+        self.assertEqual(sorted(service.getRegexCounters('.*n_ba.')),
+                         ['CounterTask.n_bar'])
+
+        # Removed tasks no longer export their counters
+        service.tasks.remove(task)
+        self.assertEqual(service.getCountersWithPrefix('CounterTask.'), {})
+        with self.assertRaises(KeyError):
+            service.getCounter('CounterTask.n_foo')
@@ -4,8 +4,9 @@
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
 #
-from sparts.sparts import option
-from sparts.vtask import ExecuteContext, VTask
+from sparts.counters import counter
+from sparts.sparts import get_options, option
+from sparts.vtask import CompactExecuteContext, ExecuteContext, VTask
 from sparts.tests.base import BaseSpartsTestCase, SingleTaskTestCase
 
 class ExecuteContextTests(BaseSpartsTestCase):
@@ -16,6 +17,25 @@ class ExecuteContextTests(BaseSpartsTestCase):
         self.assertNotEqual(ExecuteContext(item=3), ExecuteContext(item=4))
         self.assertLess(ExecuteContext(item=0), ExecuteContext(item=10))
         self.assertGreater(ExecuteContext(item=10), ExecuteContext(item=0))
+        self.assertEqual(ExecuteContext(item=1), CompactExecuteContext(item=1))
+        self.assertEqual(hash(ExecuteContext(item=1)),
+                         hash(CompactExecuteContext(item=1)))
+
+    def test_compact(self):
+        from concurrent.futures import Future
+        ctx = CompactExecuteContext(item='foo', future=Future())
+        self.assertFalse(hasattr(ctx, '__dict__'))
+        self.assertEqual(ctx.attempt, 1)
+        self.assertIs(ctx.deferred, None)
+        self.assertEqual(ctx.elapsed, 0.0)
+
+        ctx.start()
+        self.assertTrue(ctx.started)
+        self.assertTrue(ctx.future.running())
+        ctx.set_result('bar')
+        self.assertEqual(ctx.future.result(), 'bar')
+        self.assertGreaterEqual(ctx.elapsed, 0.0)
+        self.assertEqual(ctx.elapsed, ctx.elapsed)
 
 
 class VTaskOptionTests(SingleTaskTestCase):
@@ -88,3 +108,23 @@ class VTaskOptionPrefixOverrideTests(SingleTaskTestCase):
         self.assertEqual(self.task.basicopt, "foo")
         self.assertEqual(self.task.opt_uscore, "bar")
         self.assertEqual(self.task.opt_uscore2, "baz")
+
+
+class VTaskMetadataTests(BaseSpartsTestCase):
+    def test_class_metadata(self):
+        class MyTask(VTask):
+            n_foo = counter()
+            basicopt = option(default="spam")
+
+        class MySubTask(MyTask):
+            n_bar = counter()
+
+        counters = dict(MyTask._sparts_meta.counters)
+        self.assertEqual(sorted(counters), ['n_foo'])
+        self.assertIs(counters['n_foo'], MyTask.n_foo)
+        self.assertEqual(MyTask._sparts_meta.options, [MyTask.basicopt])
+
+        # Subclasses get their own metadata, including inherited attributes
+        self.assertEqual(sorted(dict(MySubTask._sparts_meta.counters)),
+                         ['n_bar', 'n_foo'])
+        self.assertEqual(len(get_options(MySubTask)), 1)
@@ -73,6 +73,16 @@ service FacebookService {
    */
   i64 getCounter(1: string key),
 
+  /**
+   * Gets the counters with the given names
+   */
+  map<string, i64> getSelectedCounters(1: list<string> keys),
+
+  /**
+   * Gets the counters whose names match a regular expression
+   */
+  map<string, i64> getRegexCounters(1: string regex),
+
   /**
    * Sets an option
    */